@@ -1,19 +1,15 @@
-from math import sin, cos, acos, sqrt, hypot, pi, log10, ceil, floor
-import argparse
+from math import sin, cos, acos, sqrt, hypot, pi, log10, ceil, floor, frexp
+import bisect
 import collections
-import dataclasses
-import decimal
+import contextlib
 import functools
 import itertools
 import logging
-import multiprocessing
 import operator
 import os
-import pprint
+import struct
 import sys
-import tempfile
 import typing
-import unittest
 
 
 __version__ = "0.1.0"
@@ -31,11 +27,26 @@ _PY37 = sys.version_info.major == 3 and sys.version_info.minor == 7
 
 
 class AppendDbV1:
-    def __init__(self, path):
+    """
+    recover: call `recover()` on open
+    footer: write `footer.bin` with sizes and a checksum on `close()`.
+    On open, `recover()` is called unless the footer matches the files.
+    """
+
+    encoding = "utf-8"  # Records are `bytes` if `None`.
+    # Sizes of the index and the data, and CRC-32 of the last record.
+    _FOOTER = struct.Struct("<QQI")
+
+    def __init__(self, path, recover=False, footer=False):
         mkdir(path)
         self.path = path
+        self.footer = footer
         self.fp_index = open(jp(path, "index.i64"), "a+b")
         self.fp_data = open(jp(path, "data.txt"), "a+b")
+        if footer and not self._pop_footer():
+            recover = True
+        if recover:
+            self.recover()
 
     def __repr__(self):
         return f"{self.__class__.__name__}({repr(self.path)})"
@@ -44,9 +55,55 @@ class AppendDbV1:
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        if self.fp_index.closed:
+            return
+        if self.footer:
+            self.flush()
+            self._write_footer()
         self.fp_index.close()
         self.fp_data.close()
 
+    def recover(self):
+        """
+        Truncate a partially written index entry and data beyond the last indexed record.
+        Trailing index entries beyond the data or out of order (e.g. zero-filled ones)
+        are dropped by a binary search assuming they are contiguous at the end.
+        The data is not scanned.
+        Returns the numbers of bytes removed from the index and the data.
+        """
+        self.flush()
+        s_index = os.fstat(self.fp_index.fileno()).st_size
+        s_data = os.fstat(self.fp_data.fileno()).st_size
+        n = s_index // 8
+        if n > 0 and not (
+            0 < self._ib_of(n - 1) <= s_data and self._is_in_order(n - 1, 0)
+        ):
+            lo, hi = 0, n
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if self._ib_of(mid) <= s_data and self._is_in_order(mid, lo):
+                    lo = mid + 1
+                else:
+                    hi = mid
+            n = lo
+        ib = self._ib1_of(n)
+        if s_index != n * 8 or s_data != ib:
+            logger.warning(
+                "Recovered %s by truncating the index from %s B to %s B "
+                "and the data from %s B to %s B.",
+                self.path,
+                s_index,
+                n * 8,
+                s_data,
+                ib,
+            )
+            self.fp_index.truncate(n * 8)
+            self.fp_data.truncate(ib)
+        return s_index - n * 8, s_data - ib
+
     def __len__(self):
         s = os.fstat(self.fp_index.fileno()).st_size
         if s % 8 != 0:
@@ -57,13 +114,12 @@ class AppendDbV1:
         i = range(len(self))[i]
         ib1, ib2 = self._ib1_of(i), self._ib2_of(i)
         self.fp_data.seek(ib1)
-        return self.fp_data.read(ib2 - ib1).decode("utf-8")
+        b = self.fp_data.read(ib2 - ib1)
+        return b if self.encoding is None else b.decode(self.encoding)
 
     def append(self, t: str):
-        b = t.encode("utf-8")
-        l = len(self)
-        ib1 = self._ib1_of(l)
-        self.fp_data.seek(ib1)
+        b = self._encode(t)
+        l, ib1 = self._truncate_tail()
         dib = self.fp_data.write(b)
         self.fp_index.seek(l * 8)
         try:
@@ -73,10 +129,235 @@ class AppendDbV1:
             raise
         self.flush()
 
+    def extend(self, ts):
+        """
+        Append `ts` with a single write to each file.
+        """
+        self._extend_bytes([self._encode(t) for t in ts])
+
+    def _extend_bytes(self, bs):
+        l, ib1 = self._truncate_tail()
+        dib = self.fp_data.write(b"".join(bs))
+        assert dib == sum(len(b) for b in bs)
+        self.fp_index.seek(l * 8)
+        try:
+            self.fp_index.write(
+                b"".join(
+                    self._bytes(ib1 + ib) for ib in itertools.accumulate(map(len, bs))
+                )
+            )
+        except OSError:
+            self.fp_index.truncate(l * 8)
+            raise
+        self.flush()
+
     def flush(self):
         self.fp_data.flush()
         self.fp_index.flush()
 
+    def sync(self):
+        """
+        `flush` and `os.fsync` the data and then the index.
+        """
+        self.flush()
+        os.fsync(self.fp_data.fileno())
+        os.fsync(self.fp_index.fileno())
+
+    def follow(self, start=0, timeout=None, max_interval=1.0, inotify=True):
+        """
+        Yield records from `start` and then new ones as they are appended.
+        New records are waited for with inotify on `index.i64` if available and `inotify`,
+        otherwise by polling with exponential backoff up to `max_interval` seconds.
+        Stops when no record is appended for `timeout` seconds (never if `None`).
+        """
+        import time
+
+        watcher = _Inotify.of(jp(self.path, "index.i64")) if inotify else None
+        try:
+            i = start
+            interval = _FOLLOW_MIN_INTERVAL
+            t_last = time.monotonic()
+            while True:
+                n = len(self)
+                if i < n:
+                    for i1 in range(i, n, _FOLLOW_BATCH):
+                        yield from self._records(i1, min(i1 + _FOLLOW_BATCH, n))
+                    i = n
+                    interval = _FOLLOW_MIN_INTERVAL
+                    t_last = time.monotonic()
+                    continue
+                dt = max_interval
+                if timeout is not None:
+                    dt = min(dt, timeout - (time.monotonic() - t_last))
+                    if dt <= 0:
+                        return
+                if watcher is None:
+                    time.sleep(min(interval, dt))
+                    interval = min(2 * interval, max_interval)
+                else:
+                    watcher.wait(dt)
+        finally:
+            if watcher is not None:
+                watcher.close()
+
+    async def afollow(self, start=0, timeout=None, max_interval=1.0, inotify=True):
+        """
+        Async iterator version of `follow`.
+        Files are read in the default executor of the loop.
+        """
+        import asyncio
+        import time
+
+        loop = asyncio.get_running_loop()
+        watcher = _Inotify.of(jp(self.path, "index.i64")) if inotify else None
+        if watcher is not None:
+            event = asyncio.Event()
+            loop.add_reader(watcher.fileno(), event.set)
+        try:
+            i = start
+            interval = _FOLLOW_MIN_INTERVAL
+            t_last = time.monotonic()
+            while True:
+                n = await loop.run_in_executor(None, len, self)
+                if i < n:
+                    for i1 in range(i, n, _FOLLOW_BATCH):
+                        for t in await loop.run_in_executor(
+                            None, self._records, i1, min(i1 + _FOLLOW_BATCH, n)
+                        ):
+                            yield t
+                    i = n
+                    interval = _FOLLOW_MIN_INTERVAL
+                    t_last = time.monotonic()
+                    continue
+                dt = max_interval
+                if timeout is not None:
+                    dt = min(dt, timeout - (time.monotonic() - t_last))
+                    if dt <= 0:
+                        return
+                if watcher is None:
+                    await asyncio.sleep(min(interval, dt))
+                    interval = min(2 * interval, max_interval)
+                else:
+                    try:
+                        await asyncio.wait_for(event.wait(), dt)
+                    except asyncio.TimeoutError:
+                        pass
+                    event.clear()
+                    watcher.drain()
+        finally:
+            if watcher is not None:
+                loop.remove_reader(watcher.fileno())
+                watcher.close()
+
+    def _records(self, i1, i2):
+        """
+        Records `[i1, i2)` read by one read of each file.
+        """
+        ib1 = self._ib1_of(i1)
+        self.fp_index.seek(i1 * 8)
+        ibs = struct.unpack(f"<{i2 - i1}Q", self.fp_index.read((i2 - i1) * 8))
+        self.fp_data.seek(ib1)
+        b = self.fp_data.read(ibs[-1] - ib1)
+        ts = [b[ib - ib1 : ib2 - ib1] for ib, ib2 in zip((ib1,) + ibs, ibs)]
+        return ts if self.encoding is None else [t.decode(self.encoding) for t in ts]
+
+    def _encode(self, t):
+        if self.encoding is not None:
+            return t.encode(self.encoding)
+        if not isinstance(t, (bytes, bytearray)):
+            raise TypeError(f"A record of {self} should be bytes: {t!r}")
+        return t
+
+    def _truncate_tail(self):
+        """
+        Truncate a partially written index entry and unindexed data left by an interrupted write,
+        since writes go to the ends of the files opened in the append mode.
+        Returns the number of records and the end of the data.
+        """
+        s_index = os.fstat(self.fp_index.fileno()).st_size
+        l = s_index // 8
+        ib = self._ib1_of(l)
+        s_data = os.fstat(self.fp_data.fileno()).st_size
+        if s_data < ib:
+            raise Error(
+                f"The index of {self.path} refers to {ib} B"
+                f" beyond the data of {s_data} B. Call recover()."
+            )
+        if s_index != l * 8 or s_data != ib:
+            logger.warning(
+                "Truncating the index of %s from %s B to %s B "
+                "and the data from %s B to %s B before writing.",
+                self.path,
+                s_index,
+                l * 8,
+                s_data,
+                ib,
+            )
+            self.fp_index.truncate(l * 8)
+            self.fp_data.truncate(ib)
+        return l, ib
+
+    def _is_in_order(self, i, n_valid):
+        """
+        Whether the end of the record `i` is not less than those of the records
+        `0`, `i // 2`, `i - 1` and `n_valid - 1`, which precede it in a valid index.
+        """
+        ib = self._ib_of(i)
+        return all(
+            self._ib_of(j) <= ib for j in {0, i // 2, i - 1, n_valid - 1} if 0 <= j < i
+        )
+
+    def _pop_footer(self):
+        """
+        Remove `footer.bin` and return whether it matched the files.
+        """
+        path = jp(self.path, "footer.bin")
+        try:
+            with open(path, "rb") as fp:
+                b = fp.read()
+        except FileNotFoundError:
+            return False
+        os.remove(path)
+        if len(b) != self._FOOTER.size + 4:
+            return False
+        import zlib
+
+        s_index, s_data, crc_last = self._FOOTER.unpack(b[:-4])
+        return (
+            self._int(b[-4:]) == zlib.crc32(b[:-4])
+            and s_index == os.fstat(self.fp_index.fileno()).st_size
+            and s_data == os.fstat(self.fp_data.fileno()).st_size
+            and s_index % 8 == 0
+            and s_data == self._ib1_of(s_index // 8)
+            and crc_last == self._crc_last()
+        )
+
+    def _write_footer(self):
+        import zlib
+
+        b = self._FOOTER.pack(
+            os.fstat(self.fp_index.fileno()).st_size,
+            os.fstat(self.fp_data.fileno()).st_size,
+            self._crc_last(),
+        )
+        path = jp(self.path, "footer.bin")
+        with open(path + ".tmp", "wb") as fp:
+            fp.write(b + zlib.crc32(b).to_bytes(4, "little"))
+        os.replace(path + ".tmp", path)
+
+    def _crc_last(self):
+        """
+        CRC-32 of the last record.
+        """
+        import zlib
+
+        n = len(self)
+        if n == 0:
+            return 0
+        ib1, ib2 = self._ib1_of(n - 1), self._ib2_of(n - 1)
+        self.fp_data.seek(ib1)
+        return zlib.crc32(self.fp_data.read(ib2 - ib1))
+
     def _ib1_of(self, i):
         return 0 if i == 0 else self._ib_of(i - 1)
 
@@ -96,6 +377,473 @@ class AppendDbV1:
         return int.from_bytes(b, "little", signed=False)
 
 
+_FOLLOW_MIN_INTERVAL = 0.001
+_FOLLOW_BATCH = 1024
+
+
+class _Inotify:
+    """
+    inotify watching modifications of a file through `ctypes`.
+    """
+
+    IN_MODIFY = 0x2
+
+    def __init__(self, fd):
+        self.fd = fd
+
+    @classmethod
+    def of(cls, path):
+        """
+        `None` if inotify is not available.
+        """
+        if not sys.platform.startswith("linux"):
+            return None
+        import ctypes
+
+        try:
+            libc = ctypes.CDLL(None, use_errno=True)
+            inotify_init1 = libc.inotify_init1
+            inotify_add_watch = libc.inotify_add_watch
+        except (OSError, AttributeError):
+            return None
+        inotify_add_watch.argtypes = (ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32)
+        fd = inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if fd < 0:
+            return None
+        if inotify_add_watch(fd, os.fsencode(path), cls.IN_MODIFY) < 0:
+            os.close(fd)
+            return None
+        return cls(fd)
+
+    def fileno(self):
+        return self.fd
+
+    def wait(self, timeout):
+        import select
+
+        select.select([self.fd], [], [], timeout)
+        self.drain()
+
+    def drain(self):
+        try:
+            while os.read(self.fd, 4096):
+                pass
+        except BlockingIOError:
+            pass
+
+    def close(self):
+        os.close(self.fd)
+
+
+class BytesAppendDbV1(AppendDbV1):
+    """
+    `AppendDbV1` of `bytes` records.
+    """
+
+    encoding = None
+
+
+class FixedAppendDbV1:
+    """
+    Records of a fixed-width NumPy `dtype` such as `[("t", "<f8"), ("n", "<i4")]` in `data.bin` without an index.
+    `dtype` may be a `struct.Struct` of a standard size format (e.g. `struct.Struct("<dI")` for `"<f8,<u4"`).
+    `array()` memory-maps the records as a structured array for vectorized column reads.
+    """
+
+    def __init__(self, path, dtype, recover=False):
+        import numpy
+
+        mkdir(path)
+        self.path = path
+        self.dtype = numpy.dtype(
+            _dtype_of_struct(dtype) if isinstance(dtype, struct.Struct) else dtype
+        )
+        assert self.dtype.itemsize > 0
+        self.fp = open(jp(path, "data.bin"), "a+b")
+        if recover:
+            self.recover()
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}({repr(self.path)}, {self.dtype})"
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __len__(self):
+        s = os.fstat(self.fp.fileno()).st_size
+        if s % self.dtype.itemsize != 0:
+            logger.warning(
+                "Incompletely written record for %s with %s B.", self.path, s
+            )
+        return s // self.dtype.itemsize
+
+    def __getitem__(self, i: int):
+        import numpy
+
+        i = range(len(self))[i]
+        self.fp.seek(i * self.dtype.itemsize)
+        return numpy.frombuffer(self.fp.read(self.dtype.itemsize), dtype=self.dtype)[0]
+
+    def append(self, record):
+        """
+        record: a tuple of fields or a `numpy.void` of `dtype`
+        """
+        import numpy
+
+        self.extend(numpy.array([record], dtype=self.dtype))
+
+    def extend(self, records):
+        """
+        records: an array of `dtype` (written without conversion) or an iterable of records
+        """
+        import numpy
+
+        records = numpy.ascontiguousarray(
+            (
+                records
+                if isinstance(records, numpy.ndarray)
+                else numpy.array(list(records), dtype=self.dtype)
+            ),
+            dtype=self.dtype,
+        )
+        self.recover()
+        self.fp.write(records.tobytes())
+        self.flush()
+
+    def array(self):
+        """
+        Read-only structured array of the current records memory-mapped from the file.
+        """
+        import numpy
+
+        n = len(self)
+        if n == 0:
+            return numpy.empty(0, dtype=self.dtype)
+        return numpy.memmap(
+            jp(self.path, "data.bin"), dtype=self.dtype, mode="r", shape=(n,)
+        )
+
+    def flush(self):
+        self.fp.flush()
+
+    def close(self):
+        self.fp.close()
+
+    def recover(self):
+        """
+        Truncate a partially written record and return the number of bytes removed.
+        """
+        self.flush()
+        s = os.fstat(self.fp.fileno()).st_size
+        ds = s % self.dtype.itemsize
+        if ds:
+            logger.warning("Recovered %s by truncating %s B.", self.path, ds)
+            self.fp.truncate(s - ds)
+        return ds
+
+
+def _dtype_of_struct(s):
+    import re
+
+    import numpy
+
+    fmt = s.format.decode() if isinstance(s.format, bytes) else s.format
+    if fmt[:1] not in ("<", ">", "!", "="):
+        raise ValueError(f"Native size and alignment are not supported: {fmt}")
+    order = {"<": "<", ">": ">", "!": ">", "=": "="}[fmt[0]]
+    fields = []
+    for n, c in re.findall(r"\s*(\d*)(.)", fmt[1:].strip()):
+        n = int(n) if n else 1
+        if c == "x":
+            fields.append(f"V{n}")
+        elif c == "s":
+            fields.append(f"S{n}")
+        elif c in _STRUCT_TO_DTYPE:
+            t = _STRUCT_TO_DTYPE[c]
+            fields.extend([t if t[-1] in "1?" else order + t] * n)
+        else:
+            raise ValueError(f"Unsupported format character {c!r}: {fmt}")
+    dtype = ",".join(fields)
+    assert numpy.dtype(dtype).itemsize == s.size, (fmt, dtype)
+    return dtype
+
+
+_STRUCT_TO_DTYPE = {
+    "c": "S1",
+    "b": "i1",
+    "B": "u1",
+    "?": "?",
+    "h": "i2",
+    "H": "u2",
+    "i": "i4",
+    "I": "u4",
+    "l": "i4",
+    "L": "u4",
+    "q": "i8",
+    "Q": "u8",
+    "e": "f2",
+    "f": "f4",
+    "d": "f8",
+}
+
+
+class SegmentedAppendDb:
+    """
+    `AppendDbV1` segments in subdirectories of `path` named by their first global index (`{start:020d}`).
+    A new segment is started when the data of the last one reaches `segment_bytes`.
+    Global indices are kept after old segments are removed by `retain`.
+    The last segment is kept open, and at most `max_open_segments` older ones are kept open for reads (least recently used ones are closed).
+    Assumes a single writer.
+    """
+
+    def __init__(self, path, segment_bytes=2**30, max_open_segments=8):
+        assert segment_bytes > 0
+        assert max_open_segments > 0
+        mkdir(path)
+        self.path = path
+        self.segment_bytes = segment_bytes
+        self.max_open_segments = max_open_segments
+        self.starts = sorted(int(name) for name in os.listdir(path) if name.isdigit())
+        if not self.starts:
+            self.starts.append(0)
+        self._last_db = None
+        self._dbs = collections.OrderedDict()  # Older segments in the order of use.
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}({repr(self.path)})"
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __len__(self):
+        """
+        The next global index, which includes records of removed segments.
+        """
+        return self.starts[-1] + len(self._db_of(self.starts[-1]))
+
+    def __getitem__(self, i: int):
+        n = len(self)
+        if i < 0:
+            i += n
+        if not self.starts[0] <= i < n:
+            raise IndexError(f"{i} is out of [{self.starts[0]}, {n})")
+        start = self.starts[bisect.bisect_right(self.starts, i) - 1]
+        return self._db_of(start)[i - start]
+
+    @property
+    def start(self):
+        """
+        The first available global index.
+        """
+        return self.starts[0]
+
+    def append(self, t: str):
+        self._last().append(t)
+
+    def extend(self, ts):
+        self._last().extend(ts)
+
+    def flush(self):
+        self._db_of(self.starts[-1]).flush()
+
+    def close(self):
+        for db in self._dbs.values():
+            db.close()
+        self._dbs.clear()
+        if self._last_db is not None:
+            self._last_db.close()
+            self._last_db = None
+
+    def retain(self, max_segments=None, max_age=None, archive=None):
+        """
+        Remove the oldest segments while there are more than `max_segments`
+        or the last modification of the oldest one is more than `max_age` seconds ago.
+        The last segment is always kept.
+        archive: called with the path of a segment before removing it, e.g. to move or compress it
+        Returns the starts of the removed segments.
+        """
+        import shutil
+        import time
+
+        assert max_segments is None or max_segments > 0
+        now = time.time()
+        removed = []
+        while len(self.starts) > 1:
+            start = self.starts[0]
+            path = self._path_of(start)
+            if not (
+                (max_segments is not None and len(self.starts) > max_segments)
+                or (
+                    max_age is not None
+                    and now - os.stat(jp(path, "data.txt")).st_mtime > max_age
+                )
+            ):
+                break
+            db = self._dbs.pop(start, None)
+            if db is not None:
+                db.close()
+            if archive is not None:
+                archive(path)
+            if os.path.exists(path):
+                shutil.rmtree(path)
+            removed.append(self.starts.pop(0))
+        return removed
+
+    def _last(self):
+        db = self._db_of(self.starts[-1])
+        if os.fstat(db.fp_data.fileno()).st_size >= self.segment_bytes:
+            self.starts.append(self.starts[-1] + len(db))
+            db.close()
+            self._last_db = None
+            db = self._db_of(self.starts[-1])
+        return db
+
+    def _db_of(self, start):
+        if start == self.starts[-1]:
+            if self._last_db is None:
+                # Only the last segment may have been torn by an interrupted write.
+                self._last_db = AppendDbV1(self._path_of(start), recover=True)
+            return self._last_db
+        db = self._dbs.get(start)
+        if db is None:
+            db = self._dbs[start] = AppendDbV1(self._path_of(start))
+            while len(self._dbs) > self.max_open_segments:
+                self._dbs.popitem(last=False)[1].close()
+        else:
+            self._dbs.move_to_end(start)
+        return db
+
+    def _path_of(self, start):
+        return jp(self.path, f"{start:020d}")
+
+
+class AsyncAppendDb:
+    """
+    `AppendDbV1` for asyncio.
+    Appends are queued and written in batches of at most `max_batch` records by a writer thread,
+    and `await append(t)` returns the index of `t` once it is synced (flushed if `not fsync`).
+    Reads run in `executor` (the default executor of the loop if `None`).
+    """
+
+    def __init__(self, path, max_batch=1024, fsync=True, executor=None, **kwargs):
+        import queue
+        import threading
+
+        assert max_batch > 0
+        self.db = AppendDbV1(path, **kwargs)
+        self.max_batch = max_batch
+        self.fsync = fsync
+        self.executor = executor
+        self._lock = threading.Lock()  # Guards the file positions.
+        self._queue = queue.SimpleQueue()
+        self._is_closed = False
+        self._writer = threading.Thread(target=self._write, daemon=True)
+        self._writer.start()
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}({repr(self.db.path)})"
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+    async def append(self, t: str):
+        import asyncio
+
+        if self._is_closed:
+            raise Error(f"{self} is closed")
+        b = self.db._encode(t)  # Only the caller of an invalid record fails.
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._queue.put((b, loop, future))
+        return await future
+
+    async def get(self, i: int):
+        import asyncio
+
+        return await asyncio.get_running_loop().run_in_executor(
+            self.executor, self._get, i
+        )
+
+    async def length(self):
+        import asyncio
+
+        return await asyncio.get_running_loop().run_in_executor(
+            self.executor, self._length
+        )
+
+    async def close(self):
+        """
+        Wait for queued appends and close the files.
+        """
+        import asyncio
+
+        if self._is_closed:
+            return
+        self._is_closed = True
+        self._queue.put(None)
+        await asyncio.get_running_loop().run_in_executor(None, self._writer.join)
+        self.db.close()
+
+    def _get(self, i):
+        with self._lock:
+            return self.db[i]
+
+    def _length(self):
+        with self._lock:
+            return len(self.db)
+
+    def _write(self):
+        import queue
+
+        is_closed = False
+        while not is_closed:
+            batch = []
+            item = self._queue.get()
+            while item is not None:
+                batch.append(item)
+                if len(batch) >= self.max_batch:
+                    break
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+            is_closed = item is None
+            if not batch:
+                continue
+            try:
+                with self._lock:
+                    l = len(self.db)
+                    self.db._extend_bytes([b for b, _, _ in batch])
+                if self.fsync:
+                    os.fsync(self.db.fp_data.fileno())
+                    os.fsync(self.db.fp_index.fileno())
+            except BaseException as e:
+                for _, loop, future in batch:
+                    loop.call_soon_threadsafe(_set_future_exception, future, e)
+            else:
+                for i, (_, loop, future) in enumerate(batch, l):
+                    loop.call_soon_threadsafe(_set_future_result, future, i)
+
+
+def _set_future_result(future, v):
+    if not future.done():
+        future.set_result(v)
+
+
+def _set_future_exception(future, e):
+    if not future.done():
+        future.set_exception(e)
+
+
 class subplots:
     def __init__(self, **kwargs):
         import matplotlib.pyplot
@@ -137,160 +885,84 @@ class rcparams:
             matplotlib.rcParams[k] = v
 
 
-if _PY37:
+def dataclass_of(cls, x, implicit_conversions=None):
+    """
+    Convert `x` of JSON-like values to `cls`, a dataclass or a type annotation.
+    A tuple of values for `cls` works like `typing.Literal` (Python 3.7).
+    """
+    import dataclasses
 
-    def dataclass_of(cls, x, implicit_conversions=None):
-        if dataclasses.is_dataclass(cls):
-            if not isinstance(x, dict):
-                raise TypeError(f"{x}: {type(x)} is not compatible with {cls}")
-            fields = {f.name: f.type for f in dataclasses.fields(cls)}
-            if set(fields.keys()) != set(x.keys()):
-                raise TypeError(f"{x}: {type(x)} is not compatible with {cls}")
-            return cls(
-                **{
-                    k: dataclass_of(
-                        fields[k], v, implicit_conversions=implicit_conversions
-                    )
-                    for k, v in x.items()
-                }
-            )
-        elif implicit_conversions and (cls in implicit_conversions):
-            return implicit_conversions[cls](x)
-        elif cls == typing.Any:
-            return x
-        elif cls == complex:
-            if not isinstance(x, (int, float, complex)):
-                raise TypeError(f"{x}: {type(x)} is not compatible with {cls}")
-            return x
-        elif cls == float:
-            if not isinstance(x, (int, float)):
-                raise TypeError(f"{x}: {type(x)} is not compatible with {cls}")
-            return x
-        elif type(cls) == type:
-            if not isinstance(x, cls):
-                raise TypeError(f"{x}: {type(x)} is not compatible with {cls}")
-            return x
-        elif isinstance(cls, tuple):
-            if x not in cls:
-                raise TypeError(f"{x} is not compatible with {cls}")
-            return x
-        elif cls.__origin__ == list or cls.__origin__ == collections.abc.Sequence:
-            vcls = cls.__args__[0]
-            return [
-                dataclass_of(vcls, v, implicit_conversions=implicit_conversions)
-                for v in x
-            ]
-        elif cls.__origin__ == dict or cls.__origin__ == collections.abc.Mapping:
-            kcls, vcls = cls.__args__
-            return {
-                dataclass_of(
-                    kcls, k, implicit_conversions=implicit_conversions
-                ): dataclass_of(vcls, v, implicit_conversions=implicit_conversions)
-                for k, v in x.items()
-            }
-        elif cls.__origin__ in (set, collections.deque):
-            vcls = cls.__args__[0]
-            return cls.__origin__(
-                dataclass_of(vcls, v, implicit_conversions=implicit_conversions)
-                for v in x
-            )
-        elif cls.__origin__ == tuple:
-            vclss = cls.__args__
-            if len(vclss) != len(x):
-                raise TypeError(f"{x}: {type(x)} is not compatible with {cls}")
-            return tuple(
-                dataclass_of(vcls, v, implicit_conversions=implicit_conversions)
-                for vcls, v in zip(vclss, x)
-            )
-        elif cls.__origin__ == typing.Union:
-            for ucls in cls.__args__:
-                try:
-                    return dataclass_of(
-                        ucls, x, implicit_conversions=implicit_conversions
-                    )
-                except TypeError:
-                    pass
+    if dataclasses.is_dataclass(cls):
+        if not isinstance(x, dict):
             raise TypeError(f"{x}: {type(x)} is not compatible with {cls}")
-        else:
-            raise ValueError(f"Unsupported value {x}: {type(x)}")
-
-
-else:
-
-    def dataclass_of(cls, x, implicit_conversions=None):
-        if dataclasses.is_dataclass(cls):
-            if not isinstance(x, dict):
-                raise TypeError(f"{x}: {type(x)} is not compatible with {cls}")
-            fields = {f.name: f.type for f in dataclasses.fields(cls)}
-            if set(fields.keys()) != set(x.keys()):
-                raise TypeError(f"{x}: {type(x)} is not compatible with {cls}")
-            return cls(
-                **{
-                    k: dataclass_of(
-                        fields[k], v, implicit_conversions=implicit_conversions
-                    )
-                    for k, v in x.items()
-                }
-            )
-        elif implicit_conversions and (cls in implicit_conversions):
-            return implicit_conversions[cls](x)
-        elif cls == typing.Any:
-            return x
-        elif cls == complex:
-            if not isinstance(x, (int, float, complex)):
-                raise TypeError(f"{x}: {type(x)} is not compatible with {cls}")
-            return x
-        elif cls == float:
-            if not isinstance(x, (int, float)):
-                raise TypeError(f"{x}: {type(x)} is not compatible with {cls}")
-            return x
-        elif type(cls) == type:
-            if not isinstance(x, cls):
-                raise TypeError(f"{x}: {type(x)} is not compatible with {cls}")
-            return x
-        elif cls.__origin__ == typing.Literal:
-            if x not in cls.__args__:
-                raise TypeError(f"{x} is not compatible with {cls}")
-            return x
-        elif cls.__origin__ == list or cls.__origin__ == collections.abc.Sequence:
-            vcls = cls.__args__[0]
-            return [
-                dataclass_of(vcls, v, implicit_conversions=implicit_conversions)
-                for v in x
-            ]
-        elif cls.__origin__ == dict or cls.__origin__ == collections.abc.Mapping:
-            kcls, vcls = cls.__args__
-            return {
-                dataclass_of(
-                    kcls, k, implicit_conversions=implicit_conversions
-                ): dataclass_of(vcls, v, implicit_conversions=implicit_conversions)
+        fields = {f.name: f.type for f in dataclasses.fields(cls)}
+        if set(fields.keys()) != set(x.keys()):
+            raise TypeError(f"{x}: {type(x)} is not compatible with {cls}")
+        return cls(
+            **{
+                k: dataclass_of(fields[k], v, implicit_conversions=implicit_conversions)
                 for k, v in x.items()
             }
-        elif cls.__origin__ in (set, collections.deque):
-            vcls = cls.__args__[0]
-            return cls.__origin__(
-                dataclass_of(vcls, v, implicit_conversions=implicit_conversions)
-                for v in x
-            )
-        elif cls.__origin__ == tuple:
-            vclss = cls.__args__
-            if len(vclss) != len(x):
-                raise TypeError(f"{x}: {type(x)} is not compatible with {cls}")
-            return tuple(
-                dataclass_of(vcls, v, implicit_conversions=implicit_conversions)
-                for vcls, v in zip(vclss, x)
-            )
-        elif cls.__origin__ == typing.Union:
-            for ucls in cls.__args__:
-                try:
-                    return dataclass_of(
-                        ucls, x, implicit_conversions=implicit_conversions
-                    )
-                except TypeError:
-                    pass
+        )
+    elif implicit_conversions and (cls in implicit_conversions):
+        return implicit_conversions[cls](x)
+    elif cls == typing.Any:
+        return x
+    elif cls == complex:
+        if not isinstance(x, (int, float, complex)):
             raise TypeError(f"{x}: {type(x)} is not compatible with {cls}")
-        else:
-            raise ValueError(f"Unsupported value {x}: {type(x)}")
+        return x
+    elif cls == float:
+        if not isinstance(x, (int, float)):
+            raise TypeError(f"{x}: {type(x)} is not compatible with {cls}")
+        return x
+    elif type(cls) == type:
+        if not isinstance(x, cls):
+            raise TypeError(f"{x}: {type(x)} is not compatible with {cls}")
+        return x
+    elif isinstance(cls, tuple):
+        if x not in cls:
+            raise TypeError(f"{x} is not compatible with {cls}")
+        return x
+    elif cls.__origin__ == getattr(typing, "Literal", None):
+        if x not in cls.__args__:
+            raise TypeError(f"{x} is not compatible with {cls}")
+        return x
+    elif cls.__origin__ == list or cls.__origin__ == collections.abc.Sequence:
+        vcls = cls.__args__[0]
+        return [
+            dataclass_of(vcls, v, implicit_conversions=implicit_conversions) for v in x
+        ]
+    elif cls.__origin__ == dict or cls.__origin__ == collections.abc.Mapping:
+        kcls, vcls = cls.__args__
+        return {
+            dataclass_of(
+                kcls, k, implicit_conversions=implicit_conversions
+            ): dataclass_of(vcls, v, implicit_conversions=implicit_conversions)
+            for k, v in x.items()
+        }
+    elif cls.__origin__ in (set, collections.deque):
+        vcls = cls.__args__[0]
+        return cls.__origin__(
+            dataclass_of(vcls, v, implicit_conversions=implicit_conversions) for v in x
+        )
+    elif cls.__origin__ == tuple:
+        vclss = cls.__args__
+        if len(vclss) != len(x):
+            raise TypeError(f"{x}: {type(x)} is not compatible with {cls}")
+        return tuple(
+            dataclass_of(vcls, v, implicit_conversions=implicit_conversions)
+            for vcls, v in zip(vclss, x)
+        )
+    elif cls.__origin__ == typing.Union:
+        for ucls in cls.__args__:
+            try:
+                return dataclass_of(ucls, x, implicit_conversions=implicit_conversions)
+            except TypeError:
+                pass
+        raise TypeError(f"{x}: {type(x)} is not compatible with {cls}")
+    else:
+        raise ValueError(f"Unsupported value {x}: {type(x)}")
 
 
 def consume(g):
@@ -562,117 +1234,303 @@ def linspace(start, stop, num=50):
 
 
 GOLDEN_RATIO = (1 + sqrt(5)) / 2
-_SPHERE_MESH_BASES = {
-    4: (
-        [(0, 1, 2), (1, 2, 3), (2, 3, 0), (0, 1, 3)],
-        [
-            (0, 0, 1),
-            (2 * sqrt(2) / 3, 0, -1 / 3),
-            (-sqrt(2) / 3, sqrt(2 / 3), -1 / 3),
-            (-sqrt(2) / 3, -sqrt(2 / 3), -1 / 3),
-        ],
-        1,
-    ),
-    8: (
-        [
-            (4, 0, 1),
-            (4, 1, 2),
-            (4, 2, 3),
-            (4, 3, 0),
-            (5, 0, 1),
-            (5, 1, 2),
-            (5, 2, 3),
-            (5, 3, 0),
-        ],
-        [(1, 0, 0), (0, 1, 0), (-1, 0, 0), (0, -1, 0), (0, 0, 1), (0, 0, -1)],
-        1,
-    ),
-    # http://en.wikipedia.org/wiki/Icosahedron#Cartesian_coordinates
-    20: (
-        [
-            (8, 9, 5),
-            (8, 9, 4),
-            (7, 5, 2),
-            (7, 5, 3),
-            (3, 1, 9),
-            (3, 1, 11),
-            (4, 6, 1),
-            (4, 6, 0),
-            (0, 2, 8),
-            (0, 2, 10),
-            (10, 11, 6),
-            (10, 11, 7),
-            (2, 8, 5),
-            (8, 4, 0),
-            (0, 6, 10),
-            (10, 7, 2),
-            (5, 3, 9),
-            (9, 4, 1),
-            (1, 6, 11),
-            (11, 3, 7),
-        ],
-        [
-            (0, 1, GOLDEN_RATIO),
-            (0, 1, -GOLDEN_RATIO),
-            (0, -1, GOLDEN_RATIO),
-            (0, -1, -GOLDEN_RATIO),
-            (1, GOLDEN_RATIO, 0),
-            (1, -GOLDEN_RATIO, 0),
-            (-1, GOLDEN_RATIO, 0),
-            (-1, -GOLDEN_RATIO, 0),
-            (GOLDEN_RATIO, 0, 1),
-            (GOLDEN_RATIO, 0, -1),
-            (-GOLDEN_RATIO, 0, 1),
-            (-GOLDEN_RATIO, 0, -1),
-        ],
-        sqrt(1 ** 2 + GOLDEN_RATIO ** 2),
-    ),
-}
 
 
-def sphere_mesh(n=0, r=1, base=20):
+@functools.lru_cache(maxsize=None)
+def _sphere_mesh_bases():
+    """
+    `{base: (triangles, points, r)}` of the base polyhedra of `sphere_mesh`.
+    """
+    return {
+        4: (
+            [(0, 1, 2), (1, 2, 3), (2, 3, 0), (0, 1, 3)],
+            [
+                (0, 0, 1),
+                (2 * sqrt(2) / 3, 0, -1 / 3),
+                (-sqrt(2) / 3, sqrt(2 / 3), -1 / 3),
+                (-sqrt(2) / 3, -sqrt(2 / 3), -1 / 3),
+            ],
+            1,
+        ),
+        8: (
+            [
+                (4, 0, 1),
+                (4, 1, 2),
+                (4, 2, 3),
+                (4, 3, 0),
+                (5, 0, 1),
+                (5, 1, 2),
+                (5, 2, 3),
+                (5, 3, 0),
+            ],
+            [(1, 0, 0), (0, 1, 0), (-1, 0, 0), (0, -1, 0), (0, 0, 1), (0, 0, -1)],
+            1,
+        ),
+        # http://en.wikipedia.org/wiki/Icosahedron#Cartesian_coordinates
+        20: (
+            [
+                (8, 9, 5),
+                (8, 9, 4),
+                (7, 5, 2),
+                (7, 5, 3),
+                (3, 1, 9),
+                (3, 1, 11),
+                (4, 6, 1),
+                (4, 6, 0),
+                (0, 2, 8),
+                (0, 2, 10),
+                (10, 11, 6),
+                (10, 11, 7),
+                (2, 8, 5),
+                (8, 4, 0),
+                (0, 6, 10),
+                (10, 7, 2),
+                (5, 3, 9),
+                (9, 4, 1),
+                (1, 6, 11),
+                (11, 3, 7),
+            ],
+            [
+                (0, 1, GOLDEN_RATIO),
+                (0, 1, -GOLDEN_RATIO),
+                (0, -1, GOLDEN_RATIO),
+                (0, -1, -GOLDEN_RATIO),
+                (1, GOLDEN_RATIO, 0),
+                (1, -GOLDEN_RATIO, 0),
+                (-1, GOLDEN_RATIO, 0),
+                (-1, -GOLDEN_RATIO, 0),
+                (GOLDEN_RATIO, 0, 1),
+                (GOLDEN_RATIO, 0, -1),
+                (-GOLDEN_RATIO, 0, 1),
+                (-GOLDEN_RATIO, 0, -1),
+            ],
+            sqrt(1 ** 2 + GOLDEN_RATIO ** 2),
+        ),
+    }
+
+
+def sphere_mesh(n=0, r=1, base=20, cache=False, cache_dir=None):
+    """
+    Returns `(triangles, points)` as `int32` [n_triangles x 3] and `float64` [n_points x 3] arrays.
+    Each edge is split once, so the mesh is closed (V - E + F == 2).
+    Children of the triangle `i` at a level are `4 * i + (0, 1, 2, 3)` at the next level,
+    and the points of a level are a prefix of the points of the next level.
+
+    cache: keep the unit mesh of `(n, base)` in an in-memory LRU cache
+    cache_dir: also store the unit mesh as `.npy` files under `cache_dir` and memory-map them on later calls (implies `cache`)
+    Cached arrays are read-only and returned without copying if `r == 1`.
+    """
     assert n >= 0
-    triangles, points, r_ = _SPHERE_MESH_BASES[base]
-    points_ = [(x / r_, y / r_, z / r_) for x, y, z in points]
+    if cache or cache_dir is not None:
+        triangles, points = _cached_unit_sphere_mesh(n, base, cache_dir)
+    else:
+        triangles, points = _unit_sphere_mesh(n, base)
+    return triangles, (points if r == 1 else r * points)
+
+
+@functools.lru_cache(maxsize=16)
+def _cached_unit_sphere_mesh(n, base, cache_dir):
+    if cache_dir is None:
+        triangles, points = _unit_sphere_mesh(n, base)
+    else:
+        triangles, points = _load_unit_sphere_mesh(n, base, cache_dir)
+    triangles.setflags(write=False)
+    points.setflags(write=False)
+    return triangles, points
+
+
+def _load_unit_sphere_mesh(n, base, cache_dir):
+    import numpy
+
+    path_triangles = jp(cache_dir, f"sphere_mesh_{base}_{n}_triangles.npy")
+    path_points = jp(cache_dir, f"sphere_mesh_{base}_{n}_points.npy")
+    try:
+        return (
+            numpy.load(path_triangles, mmap_mode="r"),
+            numpy.load(path_points, mmap_mode="r"),
+        )
+    except FileNotFoundError:
+        pass
+    mkdir(cache_dir)
+    import tempfile
+
+    for path, xs in zip((path_triangles, path_points), _unit_sphere_mesh(n, base)):
+        fd, path_tmp = tempfile.mkstemp(suffix=".npy", dir=cache_dir)
+        try:
+            with os.fdopen(fd, "wb") as fp:
+                numpy.save(fp, xs)
+            os.replace(path_tmp, path)
+        except BaseException:
+            os.remove(path_tmp)
+            raise
+    return (
+        numpy.load(path_triangles, mmap_mode="r"),
+        numpy.load(path_points, mmap_mode="r"),
+    )
+
+
+def _unit_sphere_mesh(n, base):
+    import numpy
+
+    triangles, points, r_ = _sphere_mesh_bases()[base]
+    triangles = numpy.array(triangles, dtype=numpy.int32)
+    points = numpy.array(points, dtype=numpy.float64) / r_
     for _ in range(0, n):
-        new_triangles = []
-        for triangle in triangles:
-            new_triangles.extend(_divide_triangle(triangle, points_))
-        triangles = new_triangles
-    return list(triangles), [(r * x, r * y, r * z) for x, y, z in points_]
-
-
-def _divide_triangle(triangle, points):
-    i_p1, i_p2, i_p3 = triangle
-    p1 = points[i_p1]
-    p2 = points[i_p2]
-    p3 = points[i_p3]
+        triangles, points = _divide_triangles(triangles, points)
+    return triangles, points
+
+
+def _divide_triangles(triangles, points):
+    import numpy
+
     n_points = len(points)
-    p12 = _unit_middle_point(p1, p2)
-    points.append(p12)
-    i_p12 = n_points + 0
-    p23 = _unit_middle_point(p2, p3)
-    points.append(p23)
-    i_p23 = n_points + 1
-    p31 = _unit_middle_point(p3, p1)
-    points.append(p31)
-    i_p31 = n_points + 2
-    return (
-        (i_p1, i_p12, i_p31),
-        (i_p2, i_p12, i_p23),
-        (i_p3, i_p23, i_p31),
-        (i_p12, i_p23, i_p31),
+    edges = numpy.concatenate(
+        (triangles[:, [0, 1]], triangles[:, [1, 2]], triangles[:, [2, 0]])
     )
+    edges.sort(axis=1)
+    keys = edges[:, 0].astype(numpy.int64) * n_points + edges[:, 1]
+    keys, i_edges, i_middles = numpy.unique(
+        keys, return_index=True, return_inverse=True
+    )
+    ps = points[edges[i_edges, 0]] + points[edges[i_edges, 1]]
+    ps /= numpy.sqrt((ps * ps).sum(axis=1))[:, None]
+    i_middles = (i_middles.reshape(3, -1) + n_points).astype(numpy.int32)
+    i_p12, i_p23, i_p31 = i_middles
+    i_p1, i_p2, i_p3 = triangles.T
+    new_triangles = numpy.stack(
+        (
+            numpy.stack((i_p1, i_p12, i_p31), axis=1),
+            numpy.stack((i_p2, i_p12, i_p23), axis=1),
+            numpy.stack((i_p3, i_p23, i_p31), axis=1),
+            numpy.stack((i_p12, i_p23, i_p31), axis=1),
+        ),
+        axis=1,
+    ).reshape(-1, 3)
+    return new_triangles, numpy.concatenate((points, ps))
+
+
+class SphereMeshIndex:
+    """
+    Batched nearest-vertex and containing-triangle lookup of directions on `sphere_mesh(n, r, base)`.
+    Queries descend the subdivision hierarchy from the base triangles, O(n) = O(log n_triangles) per direction.
+    Unit normals of the edge planes are precomputed for every level, and queries are processed in chunks of `chunk_size` directions.
+    """
+
+    chunk_size = 1 << 14
+
+    def __init__(self, triangles, points, n):
+        import numpy
+
+        assert n >= 0
+        triangles = numpy.asarray(triangles)
+        assert len(triangles) % 4 ** n == 0
+        points = numpy.asarray(points, dtype=numpy.float64)
+        self.points = points / numpy.sqrt((points * points).sum(axis=1))[:, None]
+        self.triangles = triangles
+        levels = [triangles]
+        for _ in range(n):
+            ts = levels[-1]
+            levels.append(numpy.stack((ts[0::4, 0], ts[1::4, 0], ts[2::4, 0]), axis=1))
+        self._levels = levels[::-1]
+        self._normals = [self._normals_of(ts) for ts in self._levels]
+        self._neighbors = _neighbors_of(triangles, len(points))
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}(<{len(self.triangles)} triangles>, <{len(self.points)} points>, {len(self._levels) - 1})"
+
+    def containing_triangle(self, xyzs):
+        """
+        xyzs: [3] or [n_directions x 3]
+        Returns the index of `triangles` containing each direction.
+        """
+        ps, is_single = self._directions_of(xyzs)
+        its = self._map_chunks(self._containing_triangle, ps)
+        return its[0] if is_single else its
+
+    def nearest_vertex(self, xyzs):
+        """
+        xyzs: [3] or [n_directions x 3]
+        Returns the index of `points` nearest to each direction.
+        """
+        ps, is_single = self._directions_of(xyzs)
+        ips = self._map_chunks(self._nearest_vertex, ps)
+        return ips[0] if is_single else ips
+
+    def _map_chunks(self, f, ps):
+        import numpy
+
+        ret = numpy.empty(len(ps), dtype=numpy.int64)
+        for i in range(0, len(ps), self.chunk_size):
+            ret[i : i + self.chunk_size] = f(ps[i : i + self.chunk_size])
+        return ret
+
+    def _containing_triangle(self, ps):
+        """
+        The score of a triangle is the minimum over its edges of the sine of the signed angle from the edge plane to a direction.
+        It is non-negative if a direction is in the triangle.
+        """
+        import numpy
+
+        n_ps = len(ps)
+        its = numpy.argmax((self._normals[0] @ ps.T).min(axis=1), axis=0)
+        for ns in self._normals[1:]:
+            candidates = 4 * its[:, None] + numpy.arange(4)
+            scores = ns[candidates].reshape(n_ps, 12, 3) @ ps[:, :, None]
+            its = 4 * its + numpy.argmax(scores.reshape(n_ps, 4, 3).min(axis=2), axis=1)
+        return its
+
+    def _nearest_vertex(self, ps):
+        import numpy
+
+        its = self._containing_triangle(ps)
+        candidates = self._neighbors[self.triangles[its]].reshape(len(ps), -1)
+        return candidates[
+            numpy.arange(len(ps)),
+            numpy.argmax((self.points[candidates] @ ps[:, :, None])[:, :, 0], axis=1),
+        ]
+
+    def _normals_of(self, ts):
+        """
+        Returns [n_triangles x 3 x 3] inward unit normals of the edge planes of each triangle.
+        """
+        import numpy
 
+        a, b, c = (self.points[ts[:, i]] for i in range(3))
+        ns = numpy.stack(
+            (numpy.cross(a, b), numpy.cross(b, c), numpy.cross(c, a)), axis=1
+        )
+        ns *= numpy.sign((ns[:, 0, :] * c).sum(axis=-1))[:, None, None]
+        ns /= numpy.sqrt((ns * ns).sum(axis=-1))[..., None]
+        return ns
+
+    @staticmethod
+    def _directions_of(xyzs):
+        import numpy
+
+        ps = numpy.asarray(xyzs, dtype=numpy.float64)
+        is_single = ps.ndim == 1
+        ps = ps.reshape(-1, 3)
+        return ps / numpy.sqrt((ps * ps).sum(axis=1))[:, None], is_single
+
+
+def _neighbors_of(triangles, n_points):
+    """
+    Returns [n_points x max_degree + 1] indices of each point and its neighbors padded by the point itself.
+    """
+    import numpy
 
-def _unit_middle_point(p1, p2):
-    x1, y1, z1 = p1
-    x2, y2, z2 = p2
-    x = (x1 + x2) / 2
-    y = (y1 + y2) / 2
-    z = (z1 + z2) / 2
-    r = sqrt(x * x + y * y + z * z)
-    return x / r, y / r, z / r
+    edges = numpy.concatenate(
+        (triangles[:, [0, 1]], triangles[:, [1, 2]], triangles[:, [2, 0]])
+    )
+    edges = numpy.unique(numpy.concatenate((edges, edges[:, ::-1])), axis=0)
+    i1s, i2s = edges.T
+    n_neighbors = numpy.bincount(i1s, minlength=n_points)
+    ranks = numpy.arange(len(edges)) - (numpy.cumsum(n_neighbors) - n_neighbors)[i1s]
+    neighbors = numpy.repeat(
+        numpy.arange(n_points)[:, None], n_neighbors.max() + 1, axis=1
+    )
+    neighbors[i1s, ranks + 1] = i2s
+    return neighbors
 
 
 def is_in_polygon(x, y, xs, ys):
@@ -711,42 +1569,522 @@ def _acos(x):
             return pi
 
 
-def is_in_convex_polygon(px, py, xys, is_counterclockwise=True):
-    if not is_counterclockwise:
-        return is_in_convex_polygon(px, py, list(reversed(xys)))
-    else:
-        assert is_convex(xys, is_counterclockwise)
-        x1, y1 = xys[0]
-        x1 -= px
-        y1 -= py
-        for x2, y2 in itertools.chain(xys, xys[0:1]):
-            x2 -= px
-            y2 -= py
-            if x1 * y2 - y1 * x2 < 0:
-                return False
-            x1 = x2
-            y1 = y2
-        return True
-
+def points_in_polygon(px, py, xs, ys):
+    """Crossing-number algorithm for arrays of points
+    (x1, y1)-(x2, y2)-...-(xn, yn)-(x1, y1)
+    points on the boundary are inside as in `is_in_polygon`.
+    Returns a boolean array of the shape of `px`.
+    """
+    import numpy
 
-def is_convex(xys, is_counterclockwise=True):
-    if not is_counterclockwise:
-        return is_convex(list(reversed(xys)))
+    px = numpy.asarray(px, dtype=numpy.float64)
+    py = numpy.asarray(py, dtype=numpy.float64)
+    assert px.shape == py.shape
+    n = len(xs)
+    assert n > 2
+    assert len(ys) == n
+    is_in = numpy.zeros(px.shape, dtype=bool)
+    is_on = numpy.zeros(px.shape, dtype=bool)
+    for i in range(n):
+        x1, y1 = xs[i - 1], ys[i - 1]
+        x2, y2 = xs[i], ys[i]
+        if y1 != y2:
+            is_in ^= ((y1 > py) != (y2 > py)) & (
+                px < x1 + (py - y1) * (x2 - x1) / (y2 - y1)
+            )
+        is_on |= (
+            ((x2 - x1) * (py - y1) == (y2 - y1) * (px - x1))
+            & (min(x1, x2) <= px)
+            & (px <= max(x1, x2))
+            & (min(y1, y2) <= py)
+            & (py <= max(y1, y2))
+        )
+    return is_in | is_on
+
+
+class PreparedPolygon:
+    """
+    Polygon (x1, y1)-(x2, y2)-...-(xn, yn)-(x1, y1) prepared for repeated containment queries.
+    Points on the boundary are inside as in `is_in_polygon`.
+    Points outside of the bounding box are rejected first.
+    Convex polygons are answered by a binary search on the fan from the first corner in O(log n),
+    where collinear and duplicate vertices are removed, others by the crossing number over the edges overlapping the horizontal slab of a point.
+    """
+
+    def __init__(self, xs, ys, n_edges_per_slab=8):
+        import numpy
+
+        n = len(xs)
+        assert n > 2
+        assert len(ys) == n
+        assert n_edges_per_slab > 0
+        self.xs = numpy.array(xs, dtype=numpy.float64)
+        self.ys = numpy.array(ys, dtype=numpy.float64)
+        self.x_min, self.x_max = self.xs.min(), self.xs.max()
+        self.y_min, self.y_max = self.ys.min(), self.ys.max()
+        xys = numpy.stack((self.xs, self.ys), axis=1)
+        self.area = signed_area(xys)
+        self.is_counterclockwise = self.area >= 0
+        self.is_convex = is_convex(xys, self.is_counterclockwise)
+        self._fan_xs = self._fan_ys = None
+        if self.is_convex:
+            fan_xs, fan_ys = _corners_of(self.xs, self.ys)
+            if len(fan_xs) > 2:
+                if self.is_counterclockwise:
+                    self._fan_xs, self._fan_ys = fan_xs, fan_ys
+                else:
+                    self._fan_xs, self._fan_ys = fan_xs[::-1], fan_ys[::-1]
+        if self._fan_xs is None:
+            self._n_slabs = max(1, n // n_edges_per_slab)
+            self._dy_slab = (self.y_max - self.y_min) / self._n_slabs or 1
+            y2s = numpy.roll(self.ys, -1)
+            i1s = self._slab_of(numpy.minimum(self.ys, y2s))
+            ns = self._slab_of(numpy.maximum(self.ys, y2s)) - i1s + 1
+            i_edges = numpy.repeat(numpy.arange(n), ns)
+            i_slabs = numpy.repeat(i1s, ns) + (
+                numpy.arange(ns.sum()) - numpy.repeat(numpy.cumsum(ns) - ns, ns)
+            )
+            order = numpy.argsort(i_slabs, kind="stable")
+            self._slab_edges = i_edges[order]
+            self._slab_starts = numpy.searchsorted(
+                i_slabs[order], numpy.arange(self._n_slabs + 1)
+            )
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}({self.xs.tolist()!r}, {self.ys.tolist()!r})"
+
+    def contains(self, x, y):
+        return bool(self.contains_points(x, y))
+
+    def contains_points(self, px, py):
+        """
+        Returns a boolean array of the shape of `px`.
+        """
+        import numpy
+
+        px = numpy.asarray(px, dtype=numpy.float64)
+        py = numpy.asarray(py, dtype=numpy.float64)
+        assert px.shape == py.shape
+        shape = px.shape
+        px = px.ravel()
+        py = py.ravel()
+        is_in = (
+            (self.x_min <= px)
+            & (px <= self.x_max)
+            & (self.y_min <= py)
+            & (py <= self.y_max)
+        )
+        (iis,) = numpy.nonzero(is_in)
+        if len(iis):
+            if self._fan_xs is not None:
+                is_in[iis] = self._contains_convex(px[iis], py[iis])
+            else:
+                is_in[iis] = self._contains_slab(px[iis], py[iis])
+        return is_in.reshape(shape)
+
+    def _contains_convex(self, px, py):
+        import numpy
+
+        xs, ys = self._fan_xs, self._fan_ys
+        n = len(xs)
+        dxs = xs - xs[0]
+        dys = ys - ys[0]
+        qxs = px - xs[0]
+        qys = py - ys[0]
+        is_in = (dxs[1] * qys - dys[1] * qxs >= 0) & (
+            dxs[n - 1] * qys - dys[n - 1] * qxs <= 0
+        )
+        lo = numpy.ones(len(px), dtype=numpy.int64)
+        hi = numpy.full(len(px), n - 1, dtype=numpy.int64)
+        while (hi - lo > 1).any():
+            mid = (lo + hi) // 2
+            is_left = dxs[mid] * qys - dys[mid] * qxs >= 0
+            lo = numpy.where(is_left, mid, lo)
+            hi = numpy.where(is_left, hi, mid)
+        return is_in & (
+            (xs[lo + 1] - xs[lo]) * (py - ys[lo])
+            - (ys[lo + 1] - ys[lo]) * (px - xs[lo])
+            >= 0
+        )
+
+    def _contains_slab(self, px, py):
+        import numpy
+
+        is_in = numpy.zeros(len(px), dtype=bool)
+        i_slabs = self._slab_of(py)
+        order = numpy.argsort(i_slabs, kind="stable")
+        bounds = numpy.searchsorted(i_slabs[order], numpy.arange(self._n_slabs + 1))
+        for i_slab in range(self._n_slabs):
+            iis = order[bounds[i_slab] : bounds[i_slab + 1]]
+            i_edges = self._slab_edges[
+                self._slab_starts[i_slab] : self._slab_starts[i_slab + 1]
+            ]
+            if len(iis) == 0 or len(i_edges) == 0:
+                continue
+            x1s, y1s = self.xs[i_edges], self.ys[i_edges]
+            i2s = (i_edges + 1) % len(self.xs)
+            x2s, y2s = self.xs[i2s], self.ys[i2s]
+            n_chunk = max(1, 2 ** 20 // len(i_edges))
+            for i1 in range(0, len(iis), n_chunk):
+                jjs = iis[i1 : i1 + n_chunk]
+                is_in[jjs] = _is_in_edges(
+                    px[jjs, None], py[jjs, None], x1s, y1s, x2s, y2s
+                )
+        return is_in
+
+    def _slab_of(self, ys):
+        import numpy
+
+        return numpy.clip(
+            numpy.floor((ys - self.y_min) / self._dy_slab).astype(numpy.int64),
+            0,
+            self._n_slabs - 1,
+        )
+
+
+def _corners_of(xs, ys):
+    """
+    Vertices of a convex polygon without duplicate and collinear ones.
+    """
+    import numpy
+
+    is_distinct = (xs != numpy.roll(xs, -1)) | (ys != numpy.roll(ys, -1))
+    xs, ys = xs[is_distinct], ys[is_distinct]
+    if len(xs) < 3:
+        return xs, ys
+    x1s, y1s = numpy.roll(xs, 1), numpy.roll(ys, 1)
+    x2s, y2s = numpy.roll(xs, -1), numpy.roll(ys, -1)
+    is_corner = (xs - x1s) * (y2s - ys) - (ys - y1s) * (x2s - xs) != 0
+    return xs[is_corner], ys[is_corner]
+
+
+class PolygonIndex:
+    """
+    Region lookup over polygons `[(xs, ys), ...]` (or `PreparedPolygon`s) through an STR-packed bounding-box tree.
+    Region ids are positions in `polygons`.
+    """
+
+    def __init__(self, polygons, node_size=16):
+        import numpy
+
+        assert len(polygons) > 0
+        assert node_size > 1
+        self.polygons = [
+            p if isinstance(p, PreparedPolygon) else PreparedPolygon(*p)
+            for p in polygons
+        ]
+        bboxes = numpy.array(
+            [(p.x_min, p.y_min, p.x_max, p.y_max) for p in self.polygons],
+            dtype=numpy.float64,
+        )
+        order = _str_order(bboxes, node_size)
+        self._ids = order
+        bboxes = bboxes[order]
+        starts = numpy.arange(len(bboxes))
+        ends = starts + 1
+        levels = []
+        while True:
+            i1s = numpy.arange(0, len(bboxes), node_size)
+            parent_bboxes = numpy.concatenate(
+                (
+                    numpy.minimum.reduceat(bboxes[:, :2], i1s),
+                    numpy.maximum.reduceat(bboxes[:, 2:], i1s),
+                ),
+                axis=1,
+            )
+            levels.append((bboxes, starts, ends))
+            bboxes = parent_bboxes
+            starts = i1s
+            ends = numpy.minimum(i1s + node_size, len(levels[-1][0]))
+            if len(bboxes) == 1:
+                levels.append((bboxes, starts, ends))
+                break
+            order = _str_order(bboxes, node_size)
+            bboxes, starts, ends = bboxes[order], starts[order], ends[order]
+        self._levels = levels[::-1]
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}(<{len(self.polygons)} polygons>)"
+
+    def __len__(self):
+        return len(self.polygons)
+
+    def lookup(self, px, py, n_chunks=None):
+        """
+        Returns the smallest id of the regions containing each point or -1.
+        n_chunks: split points into `n_chunks` and query them through `parallel_for`
+        """
+        import numpy
+
+        if n_chunks is not None:
+            return numpy.concatenate(
+                parallel_for(
+                    _lookup_polygon_index,
+                    _split_points(px, py, n_chunks),
+                    commons=(self,),
+                )
+            )
+        i_points, ids = self._matches(px, py)
+        ret = numpy.full(len(numpy.ravel(px)), -1, dtype=numpy.int64)
+        order = numpy.lexsort((ids, i_points))
+        i_points, i_firsts = numpy.unique(i_points[order], return_index=True)
+        ret[i_points] = ids[order][i_firsts]
+        return ret
+
+    def lookup_all(self, px, py, n_chunks=None):
+        """
+        Returns the sorted ids of all regions containing each point.
+        n_chunks: split points into `n_chunks` and query them through `parallel_for`
+        """
+        import numpy
+
+        if n_chunks is not None:
+            return list(
+                concat(
+                    parallel_for(
+                        _lookup_all_polygon_index,
+                        _split_points(px, py, n_chunks),
+                        commons=(self,),
+                    )
+                )
+            )
+        i_points, ids = self._matches(px, py)
+        order = numpy.lexsort((ids, i_points))
+        bounds = numpy.searchsorted(
+            i_points[order], numpy.arange(len(numpy.ravel(px)) + 1)
+        )
+        ids = ids[order].tolist()
+        return [ids[i1:i2] for i1, i2 in each_cons(bounds.tolist(), 2)]
+
+    def _matches(self, px, py):
+        """
+        Returns pairs of the indices of points and the ids of regions containing them.
+        """
+        import numpy
+
+        px = numpy.asarray(px, dtype=numpy.float64).ravel()
+        py = numpy.asarray(py, dtype=numpy.float64).ravel()
+        assert px.shape == py.shape
+        i_points = numpy.arange(len(px))
+        i_nodes = numpy.zeros(len(px), dtype=numpy.int64)
+        for i_level, (bboxes, starts, ends) in enumerate(self._levels):
+            if i_level > 0:
+                i_points, i_nodes = _expand_nodes(i_points, starts_prev, ends_prev)
+            bs = bboxes[i_nodes]
+            xs, ys = px[i_points], py[i_points]
+            is_in = (
+                (bs[:, 0] <= xs)
+                & (xs <= bs[:, 2])
+                & (bs[:, 1] <= ys)
+                & (ys <= bs[:, 3])
+            )
+            i_points, i_nodes = i_points[is_in], i_nodes[is_in]
+            starts_prev, ends_prev = starts[i_nodes], ends[i_nodes]
+        ids = self._ids[i_nodes]
+        order = numpy.argsort(ids, kind="stable")
+        i_points, ids = i_points[order], ids[order]
+        bounds = numpy.flatnonzero(numpy.diff(ids)) + 1
+        is_in = numpy.zeros(len(ids), dtype=bool)
+        for i1, i2 in each_cons([0, *bounds.tolist(), len(ids)], 2):
+            if i1 < i2:
+                jjs = i_points[i1:i2]
+                is_in[i1:i2] = self.polygons[ids[i1]].contains_points(px[jjs], py[jjs])
+        return i_points[is_in], ids[is_in]
+
+
+def _lookup_polygon_index(pxy, index):
+    return index.lookup(*pxy)
+
+
+def _lookup_all_polygon_index(pxy, index):
+    return index.lookup_all(*pxy)
+
+
+def _split_points(px, py, n_chunks):
+    import numpy
+
+    assert n_chunks > 0
+    return list(
+        zip(
+            numpy.array_split(numpy.ravel(px), n_chunks),
+            numpy.array_split(numpy.ravel(py), n_chunks),
+        )
+    )
+
+
+def _expand_nodes(i_points, starts, ends):
+    import numpy
+
+    ns = ends - starts
+    offsets = numpy.arange(ns.sum()) - numpy.repeat(numpy.cumsum(ns) - ns, ns)
+    return numpy.repeat(i_points, ns), numpy.repeat(starts, ns) + offsets
+
+
+def _str_order(bboxes, node_size):
+    """
+    Sort-Tile-Recursive order of `[(x_min, y_min, x_max, y_max), ...]`: consecutive `node_size` boxes form a node.
+    """
+    import numpy
+
+    n_slices = ceil(sqrt(ceil(len(bboxes) / node_size)))
+    n_per_slice = n_slices * node_size
+    cxs = bboxes[:, 0] + bboxes[:, 2]
+    cys = bboxes[:, 1] + bboxes[:, 3]
+    order = numpy.argsort(cxs, kind="stable")
+    for i1 in range(0, len(order), n_per_slice):
+        iis = order[i1 : i1 + n_per_slice]
+        order[i1 : i1 + n_per_slice] = iis[numpy.argsort(cys[iis], kind="stable")]
+    return order
+
+
+def _is_in_edges(px, py, x1s, y1s, x2s, y2s):
+    """
+    px, py: [n_points x 1]
+    x1s, y1s, x2s, y2s: [n_edges]
+    Crossing number of a ray to +x over the edges, with points on an edge counted as inside.
+    """
+    import numpy
+
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        is_crossing = ((y1s > py) != (y2s > py)) & (
+            px < x1s + (py - y1s) * (x2s - x1s) / (y2s - y1s)
+        )
+    is_on = (
+        ((x2s - x1s) * (py - y1s) == (y2s - y1s) * (px - x1s))
+        & (numpy.minimum(x1s, x2s) <= px)
+        & (px <= numpy.maximum(x1s, x2s))
+        & (numpy.minimum(y1s, y2s) <= py)
+        & (py <= numpy.maximum(y1s, y2s))
+    )
+    return (is_crossing.sum(axis=1) % 2 == 1) | is_on.any(axis=1)
+
+
+def is_in_convex_polygon(px, py, xys, is_counterclockwise=True):
+    assert is_convex(xys, is_counterclockwise)
+    if _is_ndarray(xys):
+        xs, ys, nexts, _ = _polygons_of([xys])
+        xs = xs - px
+        ys = ys - py
+        crosses = xs * ys[nexts] - ys * xs[nexts]
+        if is_counterclockwise:
+            return bool((crosses >= 0).all())
+        else:
+            return bool((crosses <= 0).all())
+    sign = 1 if is_counterclockwise else -1
+    x1, y1 = xys[0]
+    x1 -= px
+    y1 -= py
+    for x2, y2 in itertools.chain(xys, xys[0:1]):
+        x2 -= px
+        y2 -= py
+        if sign * (x1 * y2 - y1 * x2) < 0:
+            return False
+        x1 = x2
+        y1 = y2
+    return True
+
+
+def is_convex(xys, is_counterclockwise=True):
+    """
+    xys: [(x1, y1), ..., (xn, yn)] or [n x 2] array
+    """
+    if _is_ndarray(xys):
+        return bool(are_convex([xys], is_counterclockwise)[0])
+    assert len(xys) >= 3
+    sign = 1 if is_counterclockwise else -1
+    (x1, y1), (x2, y2), *more = xys
+    for x3, y3 in itertools.chain(more, xys[0:2]):
+        dx12 = x2 - x1
+        dy12 = y2 - y1
+        dx23 = x3 - x2
+        dy23 = y3 - y2
+        if sign * (dx12 * dy23 - dy12 * dx23) < 0:
+            return False
+        x1 = x2
+        y1 = y2
+        x2 = x3
+        y2 = y3
+    return True
+
+
+def _is_ndarray(x):
+    numpy = sys.modules.get("numpy")
+    return numpy is not None and isinstance(x, numpy.ndarray)
+
+
+def are_convex(xyss, is_counterclockwise=True):
+    """
+    xyss: [xys1, xys2, ...] with polygons of different numbers of vertices
+    """
+    import numpy
+
+    xs, ys, nexts, starts = _polygons_of(xyss)
+    dxs = xs[nexts] - xs
+    dys = ys[nexts] - ys
+    crosses = dxs * dys[nexts] - dys * dxs[nexts]
+    if is_counterclockwise:
+        return _reduce_polygons(numpy.minimum, crosses, starts) >= 0
+    else:
+        return _reduce_polygons(numpy.maximum, crosses, starts) <= 0
+
+
+def signed_area(xys):
+    """
+    Positive if (x1, y1)-(x2, y2)-...-(xn, yn)-(x1, y1) is counterclockwise.
+    """
+    return float(signed_areas([xys])[0])
+
+
+def signed_areas(xyss):
+    import numpy
+
+    xs, ys, nexts, starts = _polygons_of(xyss)
+    return _reduce_polygons(numpy.add, xs * ys[nexts] - xs[nexts] * ys, starts) / 2
+
+
+def orientation(xys):
+    """
+    1 if counterclockwise, -1 if clockwise, and 0 if degenerated.
+    """
+    return int(orientations([xys])[0])
+
+
+def orientations(xyss):
+    import numpy
+
+    return numpy.sign(signed_areas(xyss)).astype(numpy.int64)
+
+
+def _polygons_of(xyss):
+    """
+    Returns `xs` and `ys` of the concatenated vertices,
+    `nexts`, the index of the next vertex in the same polygon,
+    and `starts`, the index of the first vertex of each polygon.
+    """
+    import numpy
+
+    ns = numpy.array([len(xys) for xys in xyss], dtype=numpy.int64)
+    assert (ns >= 3).all()
+    if not xyss:
+        xys = numpy.empty((0, 2))
+    elif all(_is_ndarray(xys) for xys in xyss):
+        xys = numpy.concatenate(xyss).astype(numpy.float64, copy=False)
     else:
-        assert len(xys) >= 3
-        (x1, y1), (x2, y2), *more = xys
-        for x3, y3 in itertools.chain(more, xys[0:1]):
-            dx12 = x2 - x1
-            dy12 = y2 - y1
-            dx23 = x3 - x2
-            dy23 = y3 - y2
-            if dx12 * dy23 - dy12 * dx23 < 0:
-                return False
-            x1 = x2
-            y1 = y2
-            x2 = x3
-            y2 = y3
-        return True
+        xys = numpy.fromiter(
+            itertools.chain.from_iterable(itertools.chain.from_iterable(xyss)),
+            dtype=numpy.float64,
+            count=2 * ns.sum(),
+        ).reshape(-1, 2)
+    nexts = numpy.arange(1, len(xys) + 1)
+    starts = numpy.cumsum(ns) - ns
+    nexts[starts + ns - 1] = starts
+    return xys[:, 0], xys[:, 1], nexts, starts
+
+
+def _reduce_polygons(ufunc, xs, starts):
+    if len(starts) == 0:
+        return xs[:0]
+    return ufunc.reduceat(xs, starts)
 
 
 def seq(x1, dx, x2=None, end=True, comp=operator.le):
@@ -785,70 +2123,1082 @@ def _each_cons_iter(xs, n):
         yield ret
 
 
-def _each_cons(xs, n):
-    return [xs[i : i + n] for i in range(len(xs) - (n - 1))]
+def _each_cons(xs, n):
+    return [xs[i : i + n] for i in range(len(xs) - (n - 1))]
+
+
+def parallel_for(
+    f,
+    *indicess,
+    commons=(),
+    chunk_size=None,
+    pool=None,
+    dtype=None,
+    backend="process",
+    n_workers=None,
+    checkpoint=None,
+    retries=0,
+):
+    """
+    `parallel_for(f, xs, ys, commons=cs)` returns `[[f(x, y, *cs) for y in ys] for x in xs]`.
+    commons: NumPy arrays are placed once in shared memory and passed to `f` as read-only views,
+             others are sent once per worker through the initializer of a new pool (once per chunk of tasks with `pool`).
+             Writing to such a view raises `ValueError`, while workers got private writable copies of arrays before;
+             `f` modifying an array should modify its copy (`a.copy()`).
+             Threads share `commons` as is.
+    chunk_size: number of tasks sent to a worker at once (`ceil(n_tasks / (4 * n_workers))` if `None`)
+    pool: a `multiprocessing.Pool` (`ThreadPool` for `backend="thread"`) reused across calls and not closed
+          (a new pool is created, closed and joined if `None`)
+    dtype: return a NumPy array of `dtype` [len(xs) x len(ys)] which workers write into shared memory
+    backend: "process", "thread" for I/O-bound or GIL-releasing `f`, or "asyncio" for a coroutine function `f`
+    n_workers: number of processes or threads of a new pool, or maximum number of concurrent coroutines (unlimited if `None`)
+    checkpoint: path of an `AppendDbV1` storing completed results; completed tasks are skipped on rerun
+                (rerun only with the same `f`, `indicess` and `commons`)
+    retries: number of times a failed task is retried before raising `Error` after the other tasks complete
+    """
+    ns = [len(indices) for indices in indicess]
+    if backend == "asyncio" or checkpoint is not None or retries:
+        return _assemble(
+            iparallel_for(
+                f,
+                *indicess,
+                commons=commons,
+                chunk_size=chunk_size,
+                pool=pool,
+                backend=backend,
+                n_workers=n_workers,
+                checkpoint=checkpoint,
+                retries=retries,
+            ),
+            ns,
+            dtype,
+        )
+    if dtype is not None:
+        return _parallel_for_ndarray(
+            f, indicess, commons, chunk_size, pool, dtype, backend, n_workers
+        )
+    with _parallel_for_context(pool, commons, None, backend, n_workers) as context:
+        p, token, shared = context
+        return reshape(
+            p.map(
+                _parallel_for_call,
+                _parallel_for_tasks(f, indicess, token, shared),
+                chunksize=_chunk_size_of(ns, p, chunk_size),
+            ),
+            ns,
+        )
+
+
+def iparallel_for(
+    f,
+    *indicess,
+    commons=(),
+    chunk_size=None,
+    pool=None,
+    backend="process",
+    n_workers=None,
+    checkpoint=None,
+    retries=0,
+):
+    """
+    Streaming `parallel_for`.
+    `iparallel_for(f, xs, ys, commons=cs)` yields `((i, j), f(xs[i], ys[j], *cs))` in the order of completion.
+    Results restored from `checkpoint` are yielded first.
+    """
+    if checkpoint is None and not retries:
+        yield from _iparallel_for(
+            f, indicess, commons, chunk_size, pool, backend, n_workers, ()
+        )
+        return
+    assert retries >= 0
+    with contextlib.ExitStack() as stack:
+        done = set()
+        if checkpoint is not None:
+            db = stack.enter_context(AppendDbV1(checkpoint, recover=True))
+            for i in range(len(db)):
+                ijk, v = _load_checkpoint_record(db[i])
+                done.add(ijk)
+                yield ijk, v
+        retrying = _Retrying(f, retries)
+        failures = []
+        for ijk, (is_ok, v) in _iparallel_for(
+            retrying.acall if backend == "asyncio" else retrying,
+            indicess,
+            commons,
+            chunk_size,
+            pool,
+            backend,
+            n_workers,
+            done,
+        ):
+            if is_ok:
+                if checkpoint is not None:
+                    db.append(_dump_checkpoint_record(ijk, v))
+                yield ijk, v
+            else:
+                failures.append((ijk, v))
+        if failures:
+            raise Error(
+                f"{len(failures)} tasks failed: {[ijk for ijk, _ in failures]}"
+            ) from failures[0][1]
+
+
+def _iparallel_for(f, indicess, commons, chunk_size, pool, backend, n_workers, skip):
+    ns = [len(indices) for indices in indicess]
+    if backend == "asyncio":
+        assert pool is None
+        yield from _run_async_generator(
+            _iparallel_for_asyncio(f, indicess, commons, n_workers, skip)
+        )
+        return
+    with _parallel_for_context(pool, commons, None, backend, n_workers) as context:
+        p, token, shared = context
+        yield from p.imap_unordered(
+            _parallel_for_task,
+            _parallel_for_tasks(f, indicess, token, shared, skip),
+            chunksize=_chunk_size_of(ns, p, chunk_size),
+        )
+
+
+class _Retrying:
+    """
+    Picklable wrapper returning `(True, f(*args))`, or `(False, error)` after `retries` retries.
+    """
+
+    def __init__(self, f, retries):
+        self.f = f
+        self.retries = retries
+
+    def __call__(self, *args):
+        for i in range(self.retries + 1):
+            try:
+                return True, self.f(*args)
+            except Exception as e:
+                error = e
+                if i < self.retries:
+                    logger.warning("Retrying %r%r after %r", self.f, args, e)
+        return False, error
+
+    async def acall(self, *args):
+        for i in range(self.retries + 1):
+            try:
+                return True, await self.f(*args)
+            except Exception as e:
+                error = e
+                if i < self.retries:
+                    logger.warning("Retrying %r%r after %r", self.f, args, e)
+        return False, error
+
+
+def _dump_checkpoint_record(ijk, v):
+    import base64
+    import pickle
+
+    return (
+        " ".join(map(str, ijk))
+        + "\t"
+        + base64.b64encode(pickle.dumps(v)).decode("ascii")
+        + "\n"
+    )
+
+
+def _load_checkpoint_record(r):
+    import base64
+    import pickle
+
+    ijk, v = r.split("\t")
+    return tuple(map(int, ijk.split())), pickle.loads(base64.b64decode(v))
+
+
+def _parallel_for_ndarray(
+    f, indicess, commons, chunk_size, pool, dtype, backend, n_workers
+):
+    import numpy
+
+    ns = [len(indices) for indices in indicess]
+    assert len(ns)
+    if functools.reduce(operator.mul, ns, 1) == 0:
+        return numpy.empty(ns, dtype=dtype)
+    with contextlib.ExitStack() as stack:
+        if backend == "thread":
+            out = out_shared = numpy.empty(ns, dtype=dtype)
+        else:
+            out, out_shared = _create_shared_ndarray(ns, dtype, stack)
+        with _parallel_for_context(
+            pool, commons, out_shared, backend, n_workers
+        ) as context:
+            p, token, shared = context
+            consume(
+                p.imap_unordered(
+                    _parallel_for_store,
+                    _parallel_for_tasks(f, indicess, token, shared),
+                    chunksize=_chunk_size_of(ns, p, chunk_size),
+                )
+            )
+        if backend == "thread":
+            return out
+        ret = out.copy()
+        del out
+        return ret
+
+
+def _assemble(ijk_vs, ns, dtype):
+    assert len(ns)
+    if dtype is None:
+        ret = [None] * functools.reduce(operator.mul, ns, 1)
+        strides = [
+            functools.reduce(operator.mul, ns[i + 1 :], 1) for i in range(len(ns))
+        ]
+        for ijk, v in ijk_vs:
+            ret[sum(map(operator.mul, ijk, strides))] = v
+        return reshape(ret, ns)
+    else:
+        import numpy
+
+        ret = numpy.empty(ns, dtype=dtype)
+        for ijk, v in ijk_vs:
+            ret[ijk] = v
+        return ret
+
+
+async def _iparallel_for_asyncio(f, indicess, commons, n_workers, skip):
+    import asyncio
+
+    assert n_workers is None or n_workers > 0
+    pending = set()
+    try:
+        for ijk, xs in _index_args(indicess, skip):
+            if n_workers is not None and len(pending) >= n_workers:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    yield task.result()
+            pending.add(asyncio.ensure_future(_with_index(ijk, f(*xs, *commons))))
+        while pending:
+            done, pending = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED
+            )
+            for task in done:
+                yield task.result()
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+async def _with_index(ijk, coroutine):
+    return ijk, await coroutine
+
+
+def _run_async_generator(agen):
+    import asyncio
+
+    loop = asyncio.new_event_loop()
+    try:
+        while True:
+            try:
+                yield loop.run_until_complete(agen.__anext__())
+            except StopAsyncIteration:
+                return
+    finally:
+        loop.run_until_complete(agen.aclose())
+        loop.close()
+
+
+def _parallel_for_tasks(f, indicess, token, shared, skip=()):
+    for ijk, xs in _index_args(indicess, skip):
+        yield f, ijk, xs, token, shared
+
+
+def _index_args(indicess, skip):
+    for ijk, xs in zip(
+        itertools.product(*(range(len(indices)) for indices in indicess)),
+        itertools.product(*indicess),
+    ):
+        if ijk not in skip:
+            yield ijk, xs
+
+
+def _parallel_for_call(task):
+    f, _, xs, token, shared = task
+    _, commons = _worker_state(token, shared)
+    return f(*xs, *commons)
+
+
+def _parallel_for_task(task):
+    return task[1], _parallel_for_call(task)
+
+
+def _parallel_for_store(task):
+    f, ijk, xs, token, shared = task
+    out, commons = _worker_state(token, shared)
+    out[ijk] = f(*xs, *commons)
+
+
+@contextlib.contextmanager
+def _parallel_for_context(pool, commons, out_shared, backend, n_workers):
+    """
+    Yields a pool, a token identifying a call and `(out_shared, commons)` to be sent with tasks (`None` if sent through the initializer).
+    Threads share `(out_shared, commons)` as is with the token `None`.
+    """
+    if backend == "thread":
+        from multiprocessing.pool import ThreadPool
+
+        with (
+            _closing_pool(ThreadPool(n_workers))
+            if pool is None
+            else contextlib.nullcontext(pool)
+        ) as p:
+            yield p, None, (out_shared, commons)
+        return
+    elif backend != "process":
+        raise ValueError(f"Unsupported backend: {backend}")
+    import multiprocessing
+
+    token = os.urandom(16).hex()
+    with contextlib.ExitStack() as stack:
+        shared = (out_shared, _share_commons(commons, stack))
+        if pool is None:
+            p = stack.enter_context(
+                _closing_pool(
+                    multiprocessing.Pool(
+                        n_workers, initializer=_worker_state, initargs=(token, shared)
+                    )
+                )
+            )
+            yield p, token, None
+        else:
+            yield pool, token, shared
+
+
+@contextlib.contextmanager
+def _closing_pool(p):
+    try:
+        yield p
+    except BaseException:
+        p.terminate()
+        raise
+    else:
+        p.close()
+    finally:
+        p.join()
+
+
+_SharedNdarray = collections.namedtuple("_SharedNdarray", ("name", "shape", "dtype"))
+_worker_state_value = None
+
+
+def _share_commons(commons, stack):
+    numpy = sys.modules.get("numpy")
+    if numpy is None:
+        return commons
+    shared = []
+    for c in commons:
+        if isinstance(c, numpy.ndarray) and c.nbytes > 0 and not c.dtype.hasobject:
+            a, a_shared = _create_shared_ndarray(c.shape, c.dtype, stack)
+            a[...] = c
+            del a
+            shared.append(a_shared)
+        else:
+            shared.append(c)
+    return tuple(shared)
+
+
+def _create_shared_ndarray(shape, dtype, stack):
+    """
+    Returns an ndarray in a new shared memory, unlinked on exiting `stack`, and its descriptor.
+    """
+    import numpy
+    from multiprocessing import shared_memory
+
+    dtype = numpy.dtype(dtype)
+    assert not dtype.hasobject
+    shm = shared_memory.SharedMemory(
+        create=True, size=max(1, functools.reduce(operator.mul, shape, dtype.itemsize))
+    )
+    stack.callback(shm.unlink)
+    stack.callback(_close_shared_memory, shm)
+    return (
+        numpy.ndarray(shape, dtype=dtype, buffer=shm.buf),
+        _SharedNdarray(shm.name, tuple(shape), dtype),
+    )
+
+
+def _close_shared_memory(shm):
+    try:
+        shm.close()
+    except BufferError:
+        # Views are still alive; the mapping is released with them.
+        pass
+
+
+def _worker_state(token, shared):
+    """
+    Returns `(out, commons)` in a worker, attaching shared memory once per token.
+    """
+    global _worker_state_value
+    if token is None:
+        return shared
+    if _worker_state_value is None or _worker_state_value[0] != token:
+        assert shared is not None
+        if _worker_state_value is not None:
+            for shm in _worker_state_value[3]:
+                _close_shared_memory(shm)
+        out_shared, commons_shared = shared
+        shms = []
+        out = (
+            None
+            if out_shared is None
+            else _attach_shared_ndarray(out_shared, shms, writeable=True)
+        )
+        commons = tuple(
+            _attach_shared_ndarray(c, shms, writeable=False)
+            if isinstance(c, _SharedNdarray)
+            else c
+            for c in commons_shared
+        )
+        _worker_state_value = (token, out, commons, shms)
+    return _worker_state_value[1:3]
+
+
+def _attach_shared_ndarray(a_shared, shms, writeable):
+    import numpy
+    from multiprocessing import shared_memory
+
+    shm = shared_memory.SharedMemory(name=a_shared.name)
+    shms.append(shm)
+    a = numpy.ndarray(a_shared.shape, dtype=a_shared.dtype, buffer=shm.buf)
+    a.flags.writeable = writeable
+    return a
+
+
+def _chunk_size_of(ns, pool, chunk_size):
+    if chunk_size is not None:
+        assert chunk_size > 0
+        return chunk_size
+    n_workers = getattr(pool, "_processes", None) or os.cpu_count() or 1
+    return max(1, ceil(functools.reduce(operator.mul, ns, 1) / (4 * n_workers)))
+
+
+def reshape(xs, ns):
+    assert len(ns)
+    assert len(xs) == functools.reduce(operator.mul, ns, 1)
+    return _reshape(xs, ns)
+
+
+def _reshape(xs, ns):
+    if len(ns) == 1:
+        return xs
+    return _reshape(partition(xs, ns[-1]), ns[0:-1])
+
+
+def partition(xs, n):
+    return [xs[i - n : i] for i in range(n, len(xs) + 1, n)]
+
+
+MemoizeInfo = collections.namedtuple(
+    "MemoizeInfo", ("hits", "misses", "maxsize", "currsize", "nbytes")
+)
+
+
+def memoize(
+    f=None, *, maxsize=None, ttl=None, maxbytes=None, sizeof=sys.getsizeof, key=None
+):
+    """
+    `@memoize` or `@memoize(maxsize=1024, ttl=60)`.
+    maxsize: maximum number of entries, the least recently used one is evicted first
+    ttl: seconds for which an entry is valid
+    maxbytes: maximum total `sizeof(value)` of entries
+    key: `key(*args, **kwargs)` returning a hashable key such as `memoize_key`.
+    If `None`, only hashable positional arguments are accepted and used as the key.
+    The memoized function has `.cache` (keys to values), `.cache_clear()` and `.cache_info()`.
+    Hits and misses are `None` in `.cache_info()` of an unbounded cache without `key`,
+    which does not count them (use `profiled_memoize` to count them).
+    """
+    if f is None:
+        return functools.partial(
+            memoize,
+            maxsize=maxsize,
+            ttl=ttl,
+            maxbytes=maxbytes,
+            sizeof=sizeof,
+            key=key,
+        )
+    memoized_f, _ = _memoize(f, maxsize, ttl, maxbytes, sizeof, key)
+    return memoized_f
+
+
+def profiled_memoize(
+    f=None, *, maxsize=None, ttl=None, maxbytes=None, sizeof=sys.getsizeof, key=None
+):
+    """
+    `memoize` with `.profile`, the numbers of `"new"` and `"hit"` calls.
+    """
+    if f is None:
+        return functools.partial(
+            profiled_memoize,
+            maxsize=maxsize,
+            ttl=ttl,
+            maxbytes=maxbytes,
+            sizeof=sizeof,
+            key=key,
+        )
+    profiled_memoized_f, profile = _memoize(
+        f, maxsize, ttl, maxbytes, sizeof, key, profiled=True
+    )
+    profiled_memoized_f.profile = profile
+    return profiled_memoized_f
+
+
+def concurrent_memoize(
+    f=None, *, maxsize=None, ttl=None, maxbytes=None, sizeof=sys.getsizeof, key=None
+):
+    """
+    Thread-safe `memoize`.
+    Concurrent calls with the same arguments wait for a single call of `f` and share its value or exception.
+    """
+    if f is None:
+        return functools.partial(
+            concurrent_memoize,
+            maxsize=maxsize,
+            ttl=ttl,
+            maxbytes=maxbytes,
+            sizeof=sizeof,
+            key=key,
+        )
+    import concurrent.futures
+    import threading
+
+    cache, get, put, cache_clear, cache_info, profile = _memoize_store(
+        maxsize, ttl, maxbytes, sizeof
+    )
+    lock = threading.Lock()
+    in_flight = {}
+
+    def concurrent_memoized_f(*args, **kwargs):
+        k = args if key is None else key(*args, **kwargs)
+        with lock:
+            v = get(k)
+            if v is not _MISSING:
+                return v
+            future = in_flight.get(k)
+            is_owner = future is None
+            if is_owner:
+                future = in_flight[k] = concurrent.futures.Future()
+            else:
+                profile["hit"] += 1
+        if not is_owner:
+            return future.result()
+        try:
+            v = f(*args, **kwargs)
+        except BaseException as e:
+            with lock:
+                del in_flight[k]
+            future.set_exception(e)
+            raise
+        with lock:
+            put(k, v)
+            del in_flight[k]
+        future.set_result(v)
+        return v
+
+    def locked_cache_clear():
+        with lock:
+            cache_clear()
+
+    concurrent_memoized_f.cache = cache
+    concurrent_memoized_f.cache_clear = locked_cache_clear
+    concurrent_memoized_f.cache_info = cache_info
+    return concurrent_memoized_f
+
+
+def async_memoize(
+    f=None, *, maxsize=None, ttl=None, maxbytes=None, sizeof=sys.getsizeof, key=None
+):
+    """
+    `memoize` for a coroutine function.
+    Concurrent awaits with the same arguments share a single task running `f`.
+    """
+    if f is None:
+        return functools.partial(
+            async_memoize,
+            maxsize=maxsize,
+            ttl=ttl,
+            maxbytes=maxbytes,
+            sizeof=sizeof,
+            key=key,
+        )
+    import asyncio
+
+    cache, get, put, cache_clear, cache_info, profile = _memoize_store(
+        maxsize, ttl, maxbytes, sizeof
+    )
+    in_flight = {}
+
+    async def call(k, args, kwargs):
+        try:
+            return put(k, await f(*args, **kwargs))
+        finally:
+            del in_flight[k]
+
+    async def async_memoized_f(*args, **kwargs):
+        k = args if key is None else key(*args, **kwargs)
+        v = get(k)
+        if v is not _MISSING:
+            return v
+        task = in_flight.get(k)
+        if task is None:
+            task = in_flight[k] = asyncio.ensure_future(call(k, args, kwargs))
+        else:
+            profile["hit"] += 1
+        return await asyncio.shield(task)
+
+    async_memoized_f.cache = cache
+    async_memoized_f.cache_clear = cache_clear
+    async_memoized_f.cache_info = cache_info
+    return async_memoized_f
+
+
+def disk_memoize(path, version=None, maxbytes=None):
+    """
+    Memoize in files under `path` shared across processes.
+    Entries are keyed by SHA-256 of the qualified name of `f`, arguments and `version`
+    in a canonical form independent of `PYTHONHASHSEED` and the insertion order of dicts and sets
+    (`_canonical_bytes`), and appended to segment files which are memory-mapped for reading
+    without file locks.
+    maxbytes: the oldest segments are deleted while the files exceed `maxbytes`
+    The memoized function has `.store` and `.cache_clear()`.
+    """
+
+    def decorator(f):
+        import hashlib
+
+        store = _DiskMemoizeStore(path, maxbytes)
+        name = f"{f.__module__}.{f.__qualname__}"
+
+        def disk_memoized_f(*args, **kwargs):
+            key = hashlib.sha256(
+                _canonical_bytes((name, version, args, kwargs))
+            ).digest()
+            v = store.get(key)
+            if v is _MISSING:
+                v = f(*args, **kwargs)
+                store.put(key, v)
+            return v
+
+        disk_memoized_f.store = store
+        disk_memoized_f.cache_clear = store.clear
+        return disk_memoized_f
+
+    return decorator
+
+
+def _canonical_bytes(x):
+    """
+    Pickle of `x` with dicts and sets sorted and NumPy arrays fingerprinted as in `memoize_key`.
+    Other objects are pickled as is.
+    """
+    import pickle
+
+    return pickle.dumps(_canonical(x), protocol=4)
+
+
+def _canonical(x):
+    t = type(x)
+    if t is tuple:
+        return tuple, tuple(_canonical(v) for v in x)
+    elif t is list:
+        return list, tuple(_canonical(v) for v in x)
+    elif t is dict:
+        return dict, tuple(
+            sorted((_canonical_bytes(k), _canonical_bytes(v)) for k, v in x.items())
+        )
+    elif t in (set, frozenset):
+        return set, tuple(sorted(_canonical_bytes(v) for v in x))
+    numpy = sys.modules.get("numpy")
+    if numpy is not None and isinstance(x, numpy.ndarray):
+        return _freeze(x, False)
+    return x
+
+
+class _DiskMemoizeStore:
+    """
+    Segment files `{i:012d}.bin` of records
+    `[payload size: u64][CRC-32 of payload: u32][key: 32 B][payload: pickle]`.
+    Processes which have mapped a deleted segment keep reading it.
+    A record is appended by a single `write` to a file opened with `O_APPEND`.
+    """
+
+    _HEADER = struct.Struct("<QI32s")
+
+    def __init__(self, path, maxbytes=None):
+        import threading
+
+        assert maxbytes is None or maxbytes > 0
+        mkdir(path)
+        self.path = path
+        self.maxbytes = maxbytes
+        self.segment_bytes = None if maxbytes is None else max(1, maxbytes // 4)
+        self._lock = threading.Lock()
+        # key -> (i_segment, offset of payload, size of payload, CRC-32)
+        self._index = {}
+        self._scanned = {}  # i_segment -> offset
+        self._mmaps = {}  # i_segment -> mmap
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}({self.path!r}, maxbytes={self.maxbytes!r})"
+
+    def get(self, key):
+        import pickle
+        import zlib
+
+        with self._lock:
+            loc = self._index.get(key)
+            if loc is None:
+                self._refresh()
+                loc = self._index.get(key)
+                if loc is None:
+                    return _MISSING
+            i_segment, ib, n, crc = loc
+            m = self._mmap_of(i_segment, ib + n)
+            if m is None:
+                del self._index[key]
+                return _MISSING
+            payload = m[ib : ib + n]
+        if zlib.crc32(payload) != crc:
+            logger.warning("Broken record for %s in %s", key.hex(), self.path)
+            return _MISSING
+        return pickle.loads(payload)
+
+    def put(self, key, v):
+        import pickle
+        import zlib
+
+        payload = pickle.dumps(v, protocol=pickle.HIGHEST_PROTOCOL)
+        record = self._HEADER.pack(len(payload), zlib.crc32(payload), key) + payload
+        with self._lock:
+            i_segments = self._segments()
+            i_segment = i_segments[-1] if i_segments else 0
+            if i_segments:
+                size, ib = self._scan(i_segment)
+                # Never append after an incomplete record, which would misalign later ones.
+                if ib < size or (
+                    self.segment_bytes is not None and size >= self.segment_bytes
+                ):
+                    i_segment += 1
+            fd = os.open(
+                self._path_of(i_segment), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644
+            )
+            try:
+                n = os.write(fd, record)
+            finally:
+                os.close(fd)
+            if n != len(record):
+                raise Error(f"Partially written record to {self._path_of(i_segment)}")
+            if self.maxbytes is not None:
+                self._evict()
+
+    def clear(self):
+        with self._lock:
+            for i_segment in self._segments():
+                self._remove(i_segment)
+
+    def close(self):
+        with self._lock:
+            for m in self._mmaps.values():
+                m.close()
+            self._mmaps.clear()
+
+    def _refresh(self):
+        for i_segment in self._segments():
+            self._scan(i_segment)
+
+    def _scan(self, i_segment):
+        """
+        Index complete records of the segment and return its size and the end of them.
+        """
+        ib = self._scanned.get(i_segment, 0)
+        try:
+            size = os.stat(self._path_of(i_segment)).st_size
+        except FileNotFoundError:
+            return ib, ib
+        if size <= ib:
+            return size, ib
+        m = self._mmap_of(i_segment, size)
+        if m is None:
+            return ib, ib
+        while ib + self._HEADER.size <= len(m):
+            n, crc, key = self._HEADER.unpack_from(m, ib)
+            if ib + self._HEADER.size + n > len(m):
+                break
+            self._index[key] = (i_segment, ib + self._HEADER.size, n, crc)
+            ib += self._HEADER.size + n
+        self._scanned[i_segment] = ib
+        return len(m), ib
+
+    def _mmap_of(self, i_segment, ib_end):
+        import mmap
+
+        m = self._mmaps.get(i_segment)
+        if m is not None and len(m) >= ib_end:
+            return m
+        try:
+            with open(self._path_of(i_segment), "rb") as fp:
+                size = os.fstat(fp.fileno()).st_size
+                if size < ib_end:
+                    return None
+                m_new = mmap.mmap(fp.fileno(), size, access=mmap.ACCESS_READ)
+        except FileNotFoundError:
+            return None
+        if m is not None:
+            m.close()
+        self._mmaps[i_segment] = m_new
+        return m_new
+
+    def _evict(self):
+        i_segments = self._segments()
+        sizes = [os.stat(self._path_of(i)).st_size for i in i_segments]
+        total = sum(sizes)
+        for i_segment, size in zip(i_segments[:-1], sizes):
+            if total <= self.maxbytes:
+                break
+            self._remove(i_segment)
+            total -= size
+
+    def _remove(self, i_segment):
+        try:
+            os.remove(self._path_of(i_segment))
+        except FileNotFoundError:
+            pass
+        m = self._mmaps.pop(i_segment, None)
+        if m is not None:
+            m.close()
+        self._scanned.pop(i_segment, None)
+        self._index = {k: v for k, v in self._index.items() if v[0] != i_segment}
+
+    def _segments(self):
+        return sorted(
+            int(name[:-4])
+            for name in os.listdir(self.path)
+            if name.endswith(".bin") and name[:-4].isdigit()
+        )
+
+    def _path_of(self, i_segment):
+        return jp(self.path, f"{i_segment:012d}.bin")
+
+
+def memoize_key(*args, **kwargs):
+    """
+    Key of `memoize` for arguments including keyword, unhashable or NumPy array ones.
+    Lists, dicts and sets are frozen recursively and arrays are keyed by
+    their shape, dtype and BLAKE2b digest of their content.
+    """
+    return _freeze(args, False), tuple(
+        (k, _freeze(v, False)) for k, v in sorted(kwargs.items())
+    )
+
+
+def memoize_identity_key(*args, **kwargs):
+    """
+    `memoize_key` keying arrays by their identity instead of their content.
+    Cheaper for large arrays, but in-place modification of an array is not detected.
+    The cache keeps arrays in its keys alive.
+    """
+    return _freeze(args, True), tuple(
+        (k, _freeze(v, True)) for k, v in sorted(kwargs.items())
+    )
+
+
+class _Identity:
+    __slots__ = ("x",)
+
+    def __init__(self, x):
+        self.x = x
+
+    def __hash__(self):
+        return id(self.x)
+
+    def __eq__(self, other):
+        return isinstance(other, _Identity) and self.x is other.x
+
+
+def _freeze(x, identity):
+    t = type(x)
+    if t is tuple:
+        return tuple(_freeze(v, identity) for v in x)
+    elif t is list:
+        return list, tuple(_freeze(v, identity) for v in x)
+    elif t is dict:
+        return dict, frozenset((k, _freeze(v, identity)) for k, v in x.items())
+    elif t is set:
+        return set, frozenset(x)
+    numpy = sys.modules.get("numpy")
+    if numpy is not None and isinstance(x, numpy.ndarray):
+        if identity:
+            return _Identity(x)
+        elif x.dtype.hasobject:
+            return numpy.ndarray, x.shape, _freeze(x.tolist(), identity)
+        else:
+            import hashlib
+
+            digest = hashlib.blake2b(
+                numpy.ascontiguousarray(x).view(numpy.uint8), digest_size=16
+            ).digest()
+            return numpy.ndarray, x.shape, x.dtype.str, digest
+    return x
+
+
+_MISSING = object()
 
 
-def parallel_for(f, *indicess, commons=(), chunk_size=1):
-    p = multiprocessing.Pool()
-    ret = reshape(
-        p.starmap(
-            f,
-            (ijk + commons for ijk in itertools.product(*indicess)),
-            chunksize=chunk_size,
-        ),
-        [len(indices) for indices in indicess],
+def _memoize(f, maxsize, ttl, maxbytes, sizeof, key=None, profiled=False):
+    cache, get, put, cache_clear, cache_info, profile = _memoize_store(
+        maxsize, ttl, maxbytes, sizeof
     )
-    p.close()
-    return ret
-
+    if key is not None:
 
-def reshape(xs, ns):
-    assert len(ns)
-    assert len(xs) == functools.reduce(operator.mul, ns, 1)
-    return _reshape(xs, ns)
+        def memoized_f(*args, **kwargs):
+            k = key(*args, **kwargs)
+            retv = get(k)
+            if retv is _MISSING:
+                retv = put(k, f(*args, **kwargs))
+            return retv
 
+    elif maxsize is None and ttl is None and maxbytes is None and profiled:
 
-def _reshape(xs, ns):
-    if len(ns) == 1:
-        return xs
-    return _reshape(partition(xs, ns[-1]), ns[0:-1])
+        def memoized_f(*args):
+            if args in cache:
+                profile["hit"] += 1
+                return cache[args]
+            else:
+                profile["new"] += 1
+                cache[args] = retv = f(*args)
+                return retv
 
+    elif maxsize is None and ttl is None and maxbytes is None:
 
-def partition(xs, n):
-    return [xs[i - n : i] for i in range(n, len(xs) + 1, n)]
+        def memoized_f(*args):
+            if args in cache:
+                return cache[args]
+            else:
+                cache[args] = retv = f(*args)
+                return retv
 
+        def cache_info():
+            return MemoizeInfo(None, None, None, len(cache), None)
 
-def memoize(f):
-    cache = {}
+    else:
 
-    def memoized_f(*args):
-        if args in cache:
-            return cache[args]
-        else:
-            cache[args] = retv = f(*args)
+        def memoized_f(*args):
+            retv = get(args)
+            if retv is _MISSING:
+                retv = put(args, f(*args))
             return retv
 
     memoized_f.cache = cache
-    return memoized_f
+    memoized_f.cache_clear = cache_clear
+    memoized_f.cache_info = cache_info
+    return memoized_f, profile
 
 
-def profiled_memoize(f):
-    cache = {}
+def _memoize_store(maxsize, ttl, maxbytes, sizeof):
+    """
+    Returns `(cache, get, put, cache_clear, cache_info, profile)`.
+    `get(args)` returns `_MISSING` for an absent or expired entry and `put(args, v)` returns `v`.
+    """
+    import time
+
+    assert maxsize is None or maxsize >= 0
+    assert ttl is None or ttl > 0
+    assert maxbytes is None or maxbytes >= 0
     profile = {"new": 0, "hit": 0}
+    if maxsize is None and ttl is None and maxbytes is None:
+        cache = {}
 
-    def profiled_memoized_f(*args):
-        if args in cache:
-            profile["hit"] += 1
-            return cache[args]
-        else:
+        def get(args):
+            v = cache.get(args, _MISSING)
+            if v is not _MISSING:
+                profile["hit"] += 1
+            return v
+
+        def put(args, v):
             profile["new"] += 1
-            cache[args] = retv = f(*args)
-            return retv
+            cache[args] = v
+            return v
 
-    profiled_memoized_f.cache = cache
-    profiled_memoized_f.profile = profile
-    return profiled_memoized_f
+        def cache_clear():
+            cache.clear()
+            profile["new"] = profile["hit"] = 0
+
+        def cache_info():
+            return MemoizeInfo(profile["hit"], profile["new"], None, len(cache), None)
+
+    else:
+        cache = collections.OrderedDict()
+        expires = collections.OrderedDict()  # In the order of expiration.
+        sizes = {}
+        nbytes = 0
+        monotonic = time.monotonic
+
+        def evict(args):
+            nonlocal nbytes
+            del cache[args]
+            if ttl is not None:
+                del expires[args]
+            if maxbytes is not None:
+                nbytes -= sizes.pop(args)
+
+        def get(args):
+            if args in cache:
+                if ttl is None or monotonic() < expires[args]:
+                    profile["hit"] += 1
+                    cache.move_to_end(args)
+                    return cache[args]
+                evict(args)
+            return _MISSING
+
+        def put(args, v):
+            nonlocal nbytes
+            profile["new"] += 1
+            if args in cache:
+                evict(args)
+            cache[args] = v
+            if ttl is not None:
+                now = monotonic()
+                expires[args] = now + ttl
+                while True:
+                    k = next(iter(expires))
+                    if expires[k] > now:
+                        break
+                    evict(k)
+            if maxbytes is not None:
+                sizes[args] = sizeof(v)
+                nbytes += sizes[args]
+                while nbytes > maxbytes:
+                    evict(next(iter(cache)))
+            if maxsize is not None:
+                while len(cache) > maxsize:
+                    evict(next(iter(cache)))
+            return v
+
+        def cache_clear():
+            nonlocal nbytes
+            cache.clear()
+            expires.clear()
+            sizes.clear()
+            nbytes = 0
+            profile["new"] = profile["hit"] = 0
+
+        def cache_info():
+            return MemoizeInfo(
+                profile["hit"],
+                profile["new"],
+                maxsize,
+                len(cache),
+                None if maxbytes is None else nbytes,
+            )
+
+    return cache, get, put, cache_clear, cache_info, profile
 
 
 def _get_interval(lx):
@@ -887,6 +3237,8 @@ def get_tick_configurations(x1, x2, padding_ratio=TICK_INTERVAL_PADDING_RATIO):
 
 
 def pp(x):
+    import pprint
+
     pprint.pprint(x, stream=sys.stderr)
     return x
 
@@ -916,81 +3268,822 @@ def list_2d(n_row, n_column, init=None):
     assert n_row >= 1
     assert n_column >= 1
 
-    return [[init for _ in range(n_column)] for _ in range(n_row)]
+    return [[init for _ in range(n_column)] for _ in range(n_row)]
+
+
+def make_parse_fixed_width(fields):
+    """
+    fields: (('density', 3, int),
+             2, # skip 2 characters
+             ('opacity', 7, float))
+    """
+    lower = 0
+    upper_max = 0
+    _fields = []
+    for field in fields:
+        if isinstance(field, int):
+            upper = lower + field
+        else:
+            name, length, converter = field
+            upper = lower + length
+            _fields.append((name, lower, upper, converter))
+        if upper > upper_max:
+            upper_max = upper
+        lower = upper
+    record_width = upper_max
+
+    def parse_fixed_width(s):
+        assert len(s) >= record_width
+        return {
+            name: converter(s[lower:upper]) for name, lower, upper, converter in _fields
+        }
+
+    return parse_fixed_width
+
+
+def make_load_fixed_width(fields, newline=b"\n", block_size=2**20, background=False):
+    """
+    Vectorized `make_load(..., make_parse_fixed_width(fields))` for binary files of
+    records of the same width terminated by `newline`.
+    Widths in `fields` are in bytes.
+    Returns `load(path_or_fp, compression="infer")` yielding batches `{name: array}`.
+    Converters `int`, `float`, `str` and `bytes` are applied to whole columns by NumPy,
+    and other converters to each `str` value (an `object` array).
+    compression: `"gzip"`, `"bz2"`, `"xz"` (or `"lzma"`), `None` or `"infer"` from the extension of a path
+    block_size: bytes decompressed at a time
+    background: decompress in a thread overlapped with parsing
+    """
+    assert block_size > 0
+    lower = 0
+    record_width = 0
+    _fields = []
+    for field in fields:
+        if isinstance(field, int):
+            upper = lower + field
+        else:
+            name, length, converter = field
+            upper = lower + length
+            _fields.append((name, lower, upper, converter))
+        record_width = max(record_width, upper)
+        lower = upper
+    stride = record_width + len(newline)
+
+    def parse(b):
+        import numpy
+
+        xs = numpy.frombuffer(b, dtype=numpy.uint8).reshape(-1, stride)
+        if (xs[:, record_width:] != numpy.frombuffer(newline, dtype=numpy.uint8)).any():
+            raise Error(f"Records are not terminated by {newline!r} at {stride} B")
+        batch = {}
+        for name, lower, upper, converter in _fields:
+            us = numpy.ascontiguousarray(xs[:, lower:upper])
+            col = us.view(f"S{upper - lower}")[:, 0]
+            if converter is int:
+                batch[name] = col.astype(numpy.int64)
+            elif converter is float:
+                batch[name] = col.astype(numpy.float64)
+            elif converter is bytes:
+                batch[name] = col
+            elif converter is str:
+                batch[name] = (
+                    col.astype(f"U{upper - lower}")
+                    if (us < 0x80).all()
+                    else numpy.char.decode(col, "utf-8")
+                )
+            else:
+                v = numpy.empty(len(col), dtype=object)
+                v[:] = [converter(x.decode("utf-8")) for x in col]
+                batch[name] = v
+        return batch
+
+    def load(path_or_fp, compression="infer"):
+        blocks = _read_blocks(path_or_fp, compression, block_size)
+        if background:
+            blocks = _prefetch(blocks)
+        rest = b""
+        for block in blocks:
+            b = rest + block
+            n = len(b) // stride * stride
+            rest = b[n:]
+            if n:
+                yield parse(b[:n])
+        if rest:
+            if not rest.endswith(newline) and len(rest) + len(newline) == stride:
+                rest += newline  # No newline at the end of the file.
+            if len(rest) != stride:
+                raise Error(f"Incomplete record of {len(rest)} B: {rest!r}")
+            yield parse(rest)
+
+    return load
+
+
+def _read_blocks(path_or_fp, compression, block_size):
+    import contextlib
+
+    if compression == "infer":
+        compression = (
+            _COMPRESSION_OF_EXTENSION.get(os.path.splitext(path_or_fp)[1])
+            if isinstance(path_or_fp, (str, os.PathLike))
+            else None
+        )
+    if compression is None:
+        open_ = open
+    elif compression == "gzip":
+        import gzip
+
+        open_ = gzip.open
+    elif compression == "bz2":
+        import bz2
+
+        open_ = bz2.open
+    elif compression in ("xz", "lzma"):
+        import lzma
+
+        open_ = lzma.open
+    else:
+        raise ValueError(f"Unsupported compression: {compression}")
+    with (
+        open_(path_or_fp, "rb")
+        if isinstance(path_or_fp, (str, os.PathLike)) or compression is not None
+        else contextlib.nullcontext(path_or_fp)
+    ) as fp:
+        while True:
+            b = fp.read(block_size)
+            if not b:
+                break
+            yield b
+
+
+_COMPRESSION_OF_EXTENSION = {".gz": "gzip", ".bz2": "bz2", ".xz": "xz", ".lzma": "lzma"}
+
+
+def _prefetch(g, maxsize=4):
+    """
+    Run `g` in a thread and yield its values.
+    """
+    import queue
+    import threading
+
+    q = queue.Queue(maxsize)
+    is_stopped = threading.Event()
+
+    def produce():
+        try:
+            for v in g:
+                if is_stopped.is_set():
+                    return
+                q.put((True, v))
+        except BaseException as e:
+            q.put((False, e))
+        else:
+            q.put((True, _MISSING))
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            is_ok, v = q.get()
+            if not is_ok:
+                raise v
+            if v is _MISSING:
+                break
+            yield v
+    finally:
+        is_stopped.set()
+        while thread.is_alive():
+            try:
+                q.get_nowait()
+            except queue.Empty:
+                thread.join(0.01)
+
+
+def let(f):
+    return f()
+
+
+def mkdir(path):
+    os.makedirs(path, exist_ok=True)
+
+
+def dirname(path):
+    return os.path.dirname(path) or os.path.curdir
+
+
+def jp(path, *more):
+    return os.path.normpath(os.path.sep.join((path, os.path.sep.join(more))))
+
+
+class Instrumentation:
+    """
+    Call counts, total seconds, latency histograms and bytes read/written per hook,
+    filled while enabled by `enable_instrumentation`.
+    `histogram[i]` counts calls taking at most `2**i` µs (`i == 0` for 1 µs or less).
+    """
+
+    n_buckets = 32
+
+    def __init__(self):
+        import threading
+
+        self._lock = threading.Lock()
+        self.stats = {}
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}()"
+
+    def record(self, name, seconds, bytes_read=0, bytes_written=0):
+        us = seconds * 1e6
+        i = 0 if us <= 1 else min(frexp(us)[1], self.n_buckets - 1)
+        with self._lock:
+            s = self.stats.get(name)
+            if s is None:
+                s = self.stats[name] = dict(
+                    calls=0,
+                    seconds=0.0,
+                    bytes_read=0,
+                    bytes_written=0,
+                    histogram=[0] * self.n_buckets,
+                )
+            s["calls"] += 1
+            s["seconds"] += seconds
+            s["bytes_read"] += bytes_read
+            s["bytes_written"] += bytes_written
+            s["histogram"][i] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                name: dict(s, histogram=list(s["histogram"]))
+                for name, s in self.stats.items()
+            }
+
+    def export(self, exporter):
+        """
+        exporter: called with `snapshot()`, such as `log_exporter()` or `text_exporter()`
+        """
+        return exporter(self.snapshot())
+
+    def clear(self):
+        with self._lock:
+            self.stats.clear()
+
+
+def enable_instrumentation(instrumentation=None):
+    """
+    Replace hooked entry points (`_INSTRUMENTED`) by wrappers recording into `instrumentation`
+    (a new `Instrumentation` if `None`) and return it.
+    Disabled hooks cost nothing since the original functions are restored by `disable_instrumentation`.
+    Functions imported by `from kshramt import ...` before enabling are not hooked,
+    and `make_load` hooks loaders made while enabled.
+    """
+    global _instrumentation
+    if _instrumentation is not None:
+        raise Error("Instrumentation is already enabled")
+    _instrumentation = Instrumentation() if instrumentation is None else instrumentation
+    module = sys.modules[__name__]
+    for name, make_wrapper in _INSTRUMENTED.items():
+        owner, attr = _instrumented_target(module, name)
+        f = owner.__dict__[attr] if isinstance(owner, type) else getattr(owner, attr)
+        _instrumentation_originals[name] = f
+        setattr(owner, attr, make_wrapper(_instrumentation, name, f))
+    return _instrumentation
+
+
+def disable_instrumentation():
+    """
+    Restore the original entry points and return the `Instrumentation` (`None` if not enabled).
+    """
+    global _instrumentation
+    instrumentation, _instrumentation = _instrumentation, None
+    module = sys.modules[__name__]
+    for name, f in _instrumentation_originals.items():
+        owner, attr = _instrumented_target(module, name)
+        setattr(owner, attr, f)
+    _instrumentation_originals.clear()
+    return instrumentation
+
+
+def format_instrumentation(snapshot):
+    lines = []
+    for name, s in sorted(snapshot.items()):
+        n = s["calls"]
+        lines.append(
+            f"{name}\tcalls={n}\tseconds={s['seconds']:.6g}"
+            f"\tmean_us={1e6 * s['seconds'] / n if n else 0:.4g}"
+            f"\tbytes_read={s['bytes_read']}\tbytes_written={s['bytes_written']}"
+        )
+        lines.append(
+            "\t"
+            + " ".join(f"<={2 ** i}us:{c}" for i, c in enumerate(s["histogram"]) if c)
+        )
+    return "\n".join(lines) + "\n"
+
+
+def log_exporter(level=logging.INFO):
+    def export(snapshot):
+        logger.log(level, "Instrumentation:\n%s", format_instrumentation(snapshot))
+
+    return export
+
+
+def text_exporter(fp=sys.stderr):
+    def export(snapshot):
+        fp.write(format_instrumentation(snapshot))
+
+    return export
+
+
+_instrumentation = None
+_instrumentation_originals = {}
+
+
+def _instrumented_target(module, name):
+    *owners, attr = name.split(".")
+    owner = module
+    for o in owners:
+        owner = getattr(owner, o)
+    return owner, attr
+
+
+def _timed(instrumentation, name, f, bytes_read=None, bytes_written=None):
+    """
+    bytes_read, bytes_written: `(args, retv) -> int`
+    """
+    import time
+
+    perf_counter = time.perf_counter
+    record = instrumentation.record
+
+    @functools.wraps(f)
+    def timed_f(*args, **kwargs):
+        t1 = perf_counter()
+        retv = f(*args, **kwargs)
+        record(
+            name,
+            perf_counter() - t1,
+            0 if bytes_read is None else bytes_read(args, retv),
+            0 if bytes_written is None else bytes_written(args, retv),
+        )
+        return retv
+
+    return timed_f
+
+
+def _timed_outermost(instrumentation, name, f):
+    """
+    `_timed` recording only the outermost call of a recursive function.
+    """
+    import threading
+    import time
+
+    perf_counter = time.perf_counter
+    local = threading.local()
+
+    @functools.wraps(f)
+    def timed_f(*args, **kwargs):
+        if getattr(local, "is_active", False):
+            return f(*args, **kwargs)
+        local.is_active = True
+        t1 = perf_counter()
+        try:
+            retv = f(*args, **kwargs)
+        finally:
+            local.is_active = False
+        instrumentation.record(name, perf_counter() - t1)
+        return retv
+
+    return timed_f
+
+
+def _timed_make_load(instrumentation, name, make_load):
+    @functools.wraps(make_load)
+    def timed_make_load(record_generator, parse_record):
+        return make_load(record_generator, _timed(instrumentation, name, parse_record))
+
+    return timed_make_load
+
+
+def _timed_extend(instrumentation, name, extend):
+    timed_extend = _timed(
+        instrumentation,
+        name,
+        extend,
+        bytes_written=lambda args, _: sum(
+            _n_bytes_of(t, args[0].encoding) + 8 for t in args[1]
+        ),
+    )
+
+    @functools.wraps(extend)
+    def timed_extend_list(self, ts):
+        return timed_extend(self, list(ts))  # `ts` may be an iterator.
+
+    return timed_extend_list
+
+
+def _n_bytes_of(t, encoding):
+    return len(t) if encoding is None else len(t.encode(encoding))
+
+
+_INSTRUMENTED = {
+    "AppendDbV1.append": lambda instrumentation, name, f: _timed(
+        instrumentation,
+        name,
+        f,
+        bytes_written=lambda args, _: _n_bytes_of(args[1], args[0].encoding) + 8,
+    ),
+    "AppendDbV1.extend": _timed_extend,
+    "AppendDbV1.__getitem__": lambda instrumentation, name, f: _timed(
+        instrumentation,
+        name,
+        f,
+        bytes_read=lambda args, retv: _n_bytes_of(retv, args[0].encoding) + 16,
+    ),
+    "AppendDbV1._records": lambda instrumentation, name, f: _timed(
+        instrumentation,
+        name,
+        f,
+        bytes_read=lambda args, retv: sum(
+            _n_bytes_of(t, args[0].encoding) for t in retv
+        )
+        + 8 * (args[2] - args[1] + 1),
+    ),
+    "make_load": _timed_make_load,
+    "parallel_for": _timed,
+    "dataclass_of": _timed_outermost,
+}
+
+
+def run_benchmarks(names=None, repeat=5, scale=1):
+    """
+    Run benchmarks of hot paths and return `{name: {"n", "seconds", "per_second", "peak_bytes"}}`.
+    names: names in `_BENCHMARKS` (all if `None`)
+    repeat: the median of `repeat` runs is reported
+    scale: factor of the input sizes
+    Peak memory is measured with `tracemalloc` in a separate run.
+    """
+    import statistics
+    import time
+    import tracemalloc
+
+    assert repeat > 0
+    assert scale > 0
+    results = {}
+    for name in _BENCHMARKS if names is None else names:
+        n, run = _BENCHMARKS[name](max(1, int(_BENCHMARK_SIZES[name] * scale)))
+        dts = []
+        for _ in range(repeat):
+            t1 = time.perf_counter()
+            run()
+            dts.append(time.perf_counter() - t1)
+        dt = statistics.median(dts)
+        is_tracing = tracemalloc.is_tracing()
+        if not is_tracing:
+            tracemalloc.start()
+        try:
+            tracemalloc.reset_peak()
+            base, _ = tracemalloc.get_traced_memory()
+            run()
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            if not is_tracing:
+                tracemalloc.stop()
+        results[name] = dict(
+            n=n,
+            seconds=dt,
+            per_second=n / dt if dt > 0 else None,
+            peak_bytes=peak - base,
+        )
+    return results
+
+
+def compare_benchmarks(results, baseline, threshold=0.2):
+    """
+    Returns `[(name, key, baseline value, value)]` of `"seconds"` or `"peak_bytes"`
+    greater than the baseline by more than `threshold`.
+    Benchmarks absent in either are ignored.
+    """
+    assert threshold >= 0
+    regressions = []
+    for name, r in results.items():
+        b = baseline.get(name)
+        if b is None or b["n"] != r["n"]:
+            continue
+        for k in ("seconds", "peak_bytes"):
+            if r[k] > b[k] * (1 + threshold):
+                regressions.append((name, k, b[k], r[k]))
+    return regressions
+
+
+def _bench_AppendDbV1(n):
+    import tempfile
+
+    ts = [f"{i}\t{'x' * (i % 64)}\n" for i in range(n)]
+
+    def run():
+        with tempfile.TemporaryDirectory() as td:
+            with AppendDbV1(td) as db:
+                for t in ts:
+                    db.append(t)
+                for i in range(n):
+                    db[i]
+
+    return 2 * n, run
+
+
+def _bench_dataclass_of(n):
+    import dataclasses
+
+    @dataclasses.dataclass
+    class Station:
+        name: str
+        location: typing.Tuple[float, float]
+        channels: typing.List[str]
+        elevation: typing.Optional[float]
+
+    xs = [
+        dict(
+            name=f"S{i}", location=(i, -i / 2), channels=["BHZ", "BHN"], elevation=None
+        )
+        for i in range(n)
+    ]
+
+    def run():
+        for x in xs:
+            dataclass_of(Station, x)
+
+    return n, run
+
+
+def _bench_binning(n):
+    import random
+
+    rng = random.Random(0)
+    xs = [rng.gauss(0, 1) for _ in range(n)]
+    return n, lambda: binning(xs, 100)
+
+
+def _bench_kagan_angles(n):
+    import random
+
+    rng = random.Random(0)
+    Rs = [
+        _R_theta_phi(rng.uniform(0, pi), rng.uniform(0, 2 * pi)) for _ in range(n + 1)
+    ]
+
+    def run():
+        for P, Q in zip(Rs, Rs[1:]):
+            kagan_angles(P, Q)
+
+    return n, run
+
+
+def _bench_sphere_mesh(n):
+    triangles, _ = sphere_mesh(n)
+    return len(triangles), lambda: sphere_mesh(n)
+
+
+def _bench_is_in_polygon(n):
+    import random
+
+    rng = random.Random(0)
+    xs = [cos(2 * pi * i / 1000) for i in range(1000)]
+    ys = [sin(2 * pi * i / 1000) for i in range(1000)]
+    ps = [(rng.uniform(-1.2, 1.2), rng.uniform(-1.2, 1.2)) for _ in range(n)]
+
+    def run():
+        for x, y in ps:
+            is_in_polygon(x, y, xs, ys)
+
+    return n * len(xs), run
+
+
+def _bench_parallel_for(n):
+    return n, lambda: parallel_for(abs, range(n))
+
+
+def _bench_parallel_for_backend(workload, backend, n):
+    """
+    Every backend of `parallel_for` on every workload of `_BENCH_WORKLOADS`, compared by `per_second`.
+    Processes win on the CPU-bound pure-Python task,
+    threads on the GIL-releasing blocking task (no spawn and pickle overheads)
+    and asyncio on the coroutine task (one thread for any number of concurrent waits).
+    """
+    f, af = _BENCH_WORKLOADS[workload]
+    if backend == "serial":
+        return n, lambda: [f(i) for i in range(n)]
+    return n, lambda: parallel_for(
+        af if backend == "asyncio" else f,
+        range(n),
+        backend=backend,
+        n_workers=16 if backend == "thread" else None,
+    )
+
+
+def _bench_cpu_task(i):
+    return sum(j * j for j in range(200_000 + i))
+
+
+async def _bench_async_cpu_task(i):
+    return _bench_cpu_task(i)
+
+
+def _bench_sleep_task(i):
+    import time
+
+    time.sleep(0.02)
+    return i
+
+
+async def _bench_async_blocking_sleep_task(i):
+    return _bench_sleep_task(i)
+
+
+def _bench_sync_async_sleep_task(i):
+    import asyncio
+
+    return asyncio.run(_bench_async_sleep_task(i))
+
+
+async def _bench_async_sleep_task(i):
+    import asyncio
+
+    await asyncio.sleep(0.02)
+    return i
+
+
+# Workloads as functions for the "serial", "process" and "thread" backends and coroutine functions for "asyncio".
+_BENCH_WORKLOADS = {
+    "cpu": (_bench_cpu_task, _bench_async_cpu_task),
+    "sleep": (_bench_sleep_task, _bench_async_blocking_sleep_task),
+    "async_sleep": (_bench_sync_async_sleep_task, _bench_async_sleep_task),
+}
+_BENCH_BACKENDS = ("serial", "process", "thread", "asyncio")
+_BENCHMARKS = {
+    "AppendDbV1": _bench_AppendDbV1,
+    "dataclass_of": _bench_dataclass_of,
+    "binning": _bench_binning,
+    "kagan_angles": _bench_kagan_angles,
+    "sphere_mesh": _bench_sphere_mesh,
+    "is_in_polygon": _bench_is_in_polygon,
+    "parallel_for": _bench_parallel_for,
+    **{
+        f"parallel_for_{workload}_{backend}": functools.partial(
+            _bench_parallel_for_backend, workload, backend
+        )
+        for workload in _BENCH_WORKLOADS
+        for backend in _BENCH_BACKENDS
+    },
+}
+# Each run takes about 0.5 s or longer so that 20 % differences of the medians are beyond noise.
+_BENCHMARK_SIZES = {
+    "AppendDbV1": 50_000,
+    "dataclass_of": 25_000,
+    "binning": 2_000_000,
+    "kagan_angles": 10_000,
+    "sphere_mesh": 9,
+    "is_in_polygon": 1_000,
+    "parallel_for": 200_000,
+    "parallel_for_cpu_serial": 48,
+    "parallel_for_cpu_process": 48,
+    "parallel_for_cpu_thread": 48,
+    "parallel_for_cpu_asyncio": 48,
+    "parallel_for_sleep_serial": 30,
+    "parallel_for_sleep_process": 30,
+    "parallel_for_sleep_thread": 400,
+    "parallel_for_sleep_asyncio": 30,
+    "parallel_for_async_sleep_serial": 30,
+    "parallel_for_async_sleep_process": 30,
+    "parallel_for_async_sleep_thread": 400,
+    "parallel_for_async_sleep_asyncio": 15_000,
+}
+
+
+def _make_BenchAction():
+    import argparse
+    import json
+
+    class BenchAction(argparse.Action):
+        """
+        `--bench` prints results of `run_benchmarks` as JSON.
+        `--bench BASELINE` saves them to `BASELINE` if it does not exist,
+        otherwise exits with 1 on regressions beyond `threshold` (`compare_benchmarks`).
+        """
+
+        def __init__(
+            self,
+            option_strings,
+            dest=argparse.SUPPRESS,
+            default=argparse.SUPPRESS,
+            help=None,
+            metavar="BASELINE",
+            threshold=0.2,
+            repeat=5,
+        ):
+            super().__init__(
+                option_strings=option_strings,
+                dest=dest,
+                default=default,
+                nargs="?",
+                help=help,
+                metavar=metavar,
+            )
+            self.threshold = threshold
+            self.repeat = repeat
+
+        def __call__(self, parser, namespace, values, option_string=None):
+            results = run_benchmarks(repeat=self.repeat)
+            for name, r in results.items():
+                print(
+                    name,
+                    f"{r['seconds']:.3f} s",
+                    f"{r['per_second']:.3g} /s",
+                    f"{r['peak_bytes']} B",
+                    sep="\t",
+                    file=sys.stderr,
+                )
+            if values is None:
+                json.dump(results, sys.stdout, indent=2)
+                print()
+                parser.exit()
+            elif not os.path.exists(values):
+                mkdir(dirname(values))
+                with open(values, "w") as fp:
+                    json.dump(results, fp, indent=2)
+                parser.exit()
+            with open(values) as fp:
+                regressions = compare_benchmarks(results, json.load(fp), self.threshold)
+            if regressions:
+                parser.exit(
+                    1,
+                    "".join(
+                        f"Regression of {name}.{k}: {b:.4g} -> {v:.4g}\n"
+                        for name, k, b, v in regressions
+                    ),
+                )
+            parser.exit()
 
+    BenchAction.__module__ = __name__
+    BenchAction.__qualname__ = BenchAction.__name__
+    return BenchAction
 
-def make_parse_fixed_width(fields):
-    """
-    fields: (('density', 3, int),
-             2, # skip 2 characters
-             ('opacity', 7, float))
-    """
-    lower = 0
-    upper_max = 0
-    _fields = []
-    for field in fields:
-        if isinstance(field, int):
-            upper = lower + field
-        else:
-            name, length, converter = field
-            upper = lower + length
-            _fields.append((name, lower, upper, converter))
-        if upper > upper_max:
-            upper_max = upper
-        lower = upper
-    record_width = upper_max
 
-    def parse_fixed_width(s):
-        assert len(s) >= record_width
-        return {
-            name: converter(s[lower:upper]) for name, lower, upper, converter in _fields
-        }
+def _make_TestAction():
+    import argparse
+    import unittest
 
-    return parse_fixed_width
+    class TestAction(argparse.Action):
+        def __init__(
+            self,
+            option_strings,
+            dest=argparse.SUPPRESS,
+            default=argparse.SUPPRESS,
+            help=None,
+        ):
+            super().__init__(
+                option_strings=option_strings,
+                dest=dest,
+                default=default,
+                nargs=0,
+                help=help,
+            )
 
+        def __call__(self, parser, namespace, values, option_string=None):
+            unittest.main(argv=sys.argv[:1])
+            parser.exit()
 
-def let(f):
-    return f()
+    TestAction.__module__ = __name__
+    TestAction.__qualname__ = TestAction.__name__
+    return TestAction
 
 
-def mkdir(path):
-    os.makedirs(path, exist_ok=True)
+def _fn_for_test_parallel_for(x, y):
+    return x, y
 
 
-def dirname(path):
-    return os.path.dirname(path) or os.path.curdir
+def _fn_for_test_parallel_for_commons(i, a, n):
+    return float(a[i].sum() + n), a.flags.writeable
 
 
-def jp(path, *more):
-    return os.path.normpath(os.path.sep.join((path, os.path.sep.join(more))))
+def _fn_for_test_parallel_for_dtype(i, j, a):
+    return a[i, j] ** 2
 
 
-class TestAction(argparse.Action):
-    def __init__(
-        self,
-        option_strings,
-        dest=argparse.SUPPRESS,
-        default=argparse.SUPPRESS,
-        help=None,
-    ):
-        super().__init__(
-            option_strings=option_strings,
-            dest=dest,
-            default=default,
-            nargs=0,
-            help=help,
-        )
+async def _afn_for_test_parallel_for_dtype(i, j, a):
+    return _fn_for_test_parallel_for_dtype(i, j, a)
 
-    def __call__(self, parser, namespace, values, option_string=None):
-        unittest.main(argv=sys.argv[:1])
-        parser.exit()
 
+async def _afn_for_test_parallel_for(x, y):
+    import asyncio
 
-def _fn_for_test_parallel_for(x, y):
+    await asyncio.sleep(0.001 * (x + y))
     return x, y
 
 
-class _Tester(unittest.TestCase):
+class _Tests:
+    """
+    Tests of `_Tester`, which is `unittest.TestCase` created on demand.
+    """
+
     def test_shell_escape(self):
         for s, ex in (
             ("", "''"),
@@ -1112,25 +4205,219 @@ class _Tester(unittest.TestCase):
             self.assertAlmostEqual(x, y)
 
     def test_sphere_mesh(self):
+        import numpy
+
         triangles, points = sphere_mesh(n=2, base=4)
         self.assertEqual(len(triangles), 4 ** 3)
-        self.assertEqual(len(points), 4 ** 3)
+        self.assertEqual(len(points), 4 ** 3 // 2 + 2)
+        self.assertEqual(triangles.dtype, numpy.int32)
+        self.assertEqual(points.dtype, numpy.float64)
+        for base in (4, 8, 20):
+            for n in range(4):
+                triangles, points = sphere_mesh(n=n, r=2, base=base)
+                edges = numpy.concatenate(
+                    (triangles[:, [0, 1]], triangles[:, [1, 2]], triangles[:, [2, 0]])
+                )
+                edges.sort(axis=1)
+                n_edges = len(numpy.unique(edges, axis=0))
+                self.assertEqual(len(points) - n_edges + len(triangles), 2)
+                self.assertEqual(n_edges * 2, len(triangles) * 3)
+                self.assertTrue(
+                    numpy.allclose(numpy.sqrt((points * points).sum(axis=1)), 2)
+                )
 
-    def test__divide_triangle(self):
-        points = [(0, 0, 1), (1, 0, 0), (0, 1, 0)]
-        triangles = _divide_triangle((0, 1, 2), points)
-        self.assertEqual(triangles, ((0, 3, 5), (1, 3, 4), (2, 4, 5), (3, 4, 5)))
+    def test_instrumentation(self):
+        import dataclasses
+        import io
+        import tempfile
+
+        @dataclasses.dataclass
+        class c:
+            x: typing.List[int]
+
+        append = AppendDbV1.append
+        parallel_for_ = parallel_for
+        self.assertIsNone(disable_instrumentation())
+        instrumentation = enable_instrumentation()
+        with self.assertRaises(Error):
+            enable_instrumentation()
+        try:
+            with tempfile.TemporaryDirectory() as td:
+                with AppendDbV1(td) as db:
+                    db.append("abc")
+                    db.append("d")
+                    self.assertEqual(db[0], "abc")
+                    db.extend(t for t in ("ef", "g"))
+                    self.assertEqual(
+                        list(db.follow(timeout=0, inotify=False)),
+                        ["abc", "d", "ef", "g"],
+                    )
+            load = make_load(lambda fp: fp, int)
+            self.assertEqual(list(load(["1", "2", "3"])), [1, 2, 3])
+            self.assertEqual(
+                parallel_for(_fn_for_test_parallel_for, [1, 2], [3], backend="thread"),
+                [[(1, 3)], [(2, 3)]],
+            )
+            self.assertEqual(dataclass_of(c, dict(x=[1, 2])), c([1, 2]))
+        finally:
+            self.assertIs(disable_instrumentation(), instrumentation)
+        self.assertIs(AppendDbV1.append, append)
+        self.assertIs(globals()["parallel_for"], parallel_for_)
+        snapshot = instrumentation.snapshot()
         self.assertEqual(
-            points,
+            {name: s["calls"] for name, s in snapshot.items()},
+            {
+                "AppendDbV1.append": 2,
+                "AppendDbV1.extend": 1,
+                "AppendDbV1.__getitem__": 1,
+                "AppendDbV1._records": 1,
+                "make_load": 3,
+                "parallel_for": 1,
+                "dataclass_of": 1,
+            },
+        )
+        self.assertEqual(snapshot["AppendDbV1.append"]["bytes_written"], 4 + 2 * 8)
+        self.assertEqual(snapshot["AppendDbV1.__getitem__"]["bytes_read"], 3 + 16)
+        self.assertEqual(snapshot["AppendDbV1.extend"]["bytes_written"], 3 + 2 * 8)
+        self.assertEqual(snapshot["AppendDbV1._records"]["bytes_read"], 7 + 5 * 8)
+        for s in snapshot.values():
+            self.assertEqual(sum(s["histogram"]), s["calls"])
+
+        fp = io.StringIO()
+        instrumentation.export(text_exporter(fp))
+        self.assertIn("parallel_for\tcalls=1\t", fp.getvalue())
+        with self.assertLogs(logger, logging.DEBUG) as cm:
+            instrumentation.export(log_exporter(logging.DEBUG))
+        self.assertIn("make_load\tcalls=3\t", cm.output[0])
+        calls = []
+        instrumentation.export(calls.append)
+        self.assertEqual(calls, [snapshot])
+        instrumentation.clear()
+        self.assertEqual(instrumentation.snapshot(), {})
+
+    def test_run_benchmarks(self):
+        results = run_benchmarks(repeat=1, scale=0.01)
+        self.assertEqual(set(results), set(_BENCHMARKS))
+        for r in results.values():
+            self.assertGreater(r["n"], 0)
+            self.assertGreaterEqual(r["seconds"], 0)
+            self.assertGreaterEqual(r["peak_bytes"], 0)
+        self.assertEqual(compare_benchmarks(results, results), [])
+        baseline = dict(
+            a=dict(n=1, seconds=1.0, peak_bytes=100),
+            b=dict(n=1, seconds=1.0, peak_bytes=100),
+            c=dict(n=1, seconds=1.0, peak_bytes=100),
+        )
+        self.assertEqual(
+            compare_benchmarks(
+                dict(
+                    a=dict(n=1, seconds=1.1, peak_bytes=200),
+                    b=dict(n=2, seconds=9.0, peak_bytes=900),
+                    d=dict(n=1, seconds=9.0, peak_bytes=900),
+                ),
+                baseline,
+                threshold=0.2,
+            ),
+            [("a", "peak_bytes", 100, 200)],
+        )
+
+    def test_lazy_imports(self):
+        import subprocess
+
+        lazy = (
+            "argparse",
+            "dataclasses",
+            "decimal",
+            "multiprocessing",
+            "numpy",
+            "pprint",
+            "tempfile",
+            "unittest",
+        )
+        env = dict(os.environ, PYTHONPATH=dirname(os.path.abspath(__file__)))
+        p = subprocess.run(
             [
-                (0, 0, 1),
-                (1, 0, 0),
-                (0, 1, 0),
-                (0.707_106_781_186_547_5, 0.0, 0.707_106_781_186_547_5),
-                (0.707_106_781_186_547_5, 0.707_106_781_186_547_5, 0.0),
-                (0.0, 0.707_106_781_186_547_5, 0.707_106_781_186_547_5),
+                sys.executable,
+                "-c",
+                "import sys; import kshramt; print(*sorted(sys.modules))",
             ],
+            env=env,
+            capture_output=True,
+            text=True,
+            check=True,
         )
+        self.assertIn("kshramt", p.stdout.split())
+        self.assertFalse(set(lazy) & set(p.stdout.split()))
+
+    def test_sphere_mesh_cache(self):
+        import tempfile
+
+        import numpy
+
+        triangles, points = sphere_mesh(n=3, r=2, base=8)
+        triangles_1, points_1 = sphere_mesh(n=3, base=8, cache=True)
+        triangles_2, points_2 = sphere_mesh(n=3, base=8, cache=True)
+        self.assertIs(points_1, points_2)
+        self.assertFalse(points_1.flags.writeable)
+        self.assertTrue(numpy.array_equal(triangles, triangles_1))
+        self.assertTrue(numpy.allclose(points, 2 * points_1))
+        with tempfile.TemporaryDirectory() as td:
+            triangles_1, points_1 = sphere_mesh(n=3, r=2, base=8, cache_dir=td)
+            self.assertEqual(
+                sorted(os.listdir(td)),
+                ["sphere_mesh_8_3_points.npy", "sphere_mesh_8_3_triangles.npy"],
+            )
+            self.assertTrue(numpy.array_equal(triangles, triangles_1))
+            self.assertTrue(numpy.allclose(points, points_1))
+            _cached_unit_sphere_mesh.cache_clear()
+            triangles_2, points_2 = sphere_mesh(n=3, base=8, cache_dir=td)
+            self.assertIsInstance(points_2, numpy.memmap)
+            self.assertTrue(numpy.array_equal(triangles, triangles_2))
+            self.assertTrue(numpy.allclose(points, 2 * points_2))
+            del triangles_1, points_1, triangles_2, points_2
+            _cached_unit_sphere_mesh.cache_clear()
+
+    def test_SphereMeshIndex(self):
+        import numpy
+
+        random = numpy.random.default_rng(42)
+        for base in (4, 8, 20):
+            for n in (0, 3):
+                triangles, points = sphere_mesh(n=n, r=3, base=base)
+                index = SphereMeshIndex(triangles, points, n)
+                ps = random.normal(size=(500, 3))
+                ps = numpy.concatenate((ps, points[:10], -points[:10]))
+                ips = index.nearest_vertex(ps)
+                us = ps / numpy.sqrt((ps * ps).sum(axis=1))[:, None]
+                cs = (us[:, None, :] * points[None, :, :] / 3).sum(axis=2)
+                self.assertTrue(
+                    numpy.allclose(cs[numpy.arange(len(ps)), ips], cs.max(axis=1))
+                )
+                its = index.containing_triangle(ps)
+                for u, t in zip(us, triangles[its]):
+                    a, b, c = points[t]
+                    coefficients = numpy.linalg.solve(numpy.array((a, b, c)).T, u)
+                    self.assertTrue((coefficients >= -1e-9).all())
+                self.assertEqual(index.nearest_vertex(points[3]), 3)
+                self.assertEqual(index.containing_triangle(ps[0]), its[0])
+                index.chunk_size = 7
+                self.assertEqual(index.containing_triangle(ps).tolist(), its.tolist())
+                self.assertEqual(index.nearest_vertex(ps).tolist(), ips.tolist())
+                self.assertEqual(len(index.nearest_vertex(numpy.empty((0, 3)))), 0)
+
+    def test__divide_triangles(self):
+        import numpy
+
+        triangles, points = _divide_triangles(
+            numpy.array([(0, 1, 2)], dtype=numpy.int32),
+            numpy.array([(0, 0, 1), (1, 0, 0), (0, 1, 0)], dtype=numpy.float64),
+        )
+        self.assertEqual(
+            triangles.tolist(), [[0, 3, 4], [1, 3, 5], [2, 5, 4], [3, 5, 4]]
+        )
+        for p, (i1, i2) in zip(points[3:], ((0, 1), (0, 2), (1, 2))):
+            m = points[i1] + points[i2]
+            self.assertTrue(numpy.allclose(p, m / numpy.sqrt((m * m).sum())))
 
     def test_is_in_polygon(self):
         with self.assertRaises(AssertionError):
@@ -1152,7 +4439,130 @@ class _Tester(unittest.TestCase):
             )
         )
 
+    def test_points_in_polygon(self):
+        import numpy
+
+        with self.assertRaises(AssertionError):
+            points_in_polygon([1], [2], [1, 2], [1, 2])
+        with self.assertRaises(AssertionError):
+            points_in_polygon([1], [2], [1, 2, 3], [1, 2, 3, 4])
+        for px, py, xs, ys in (
+            ([1, 1, 2, 1, 0], [2, 0, 1, 2, 1], [0, 2, 2, 0], [0, 0, 2, 2]),
+            ([1, 1, 3, -1], [2, 1, 1, 1], [0, 2, 2, 0], [0, 0, 3, 3]),
+            ([1, 1.5, 3], [2, 0.5, 1], [0, 2, 2, 0], [0, 0, 1, 1]),
+            (
+                [135.9675, 131, 130.6],
+                [35.5805, 33, 32.5],
+                [130.5, 131, 131.6, 131.5, 130.3],
+                [32.3, 32.6, 33.4, 33.5, 32.8],
+            ),
+        ):
+            self.assertEqual(
+                points_in_polygon(px, py, xs, ys).tolist(),
+                [is_in_polygon(x, y, xs, ys) for x, y in zip(px, py)],
+            )
+        random = numpy.random.default_rng(42)
+        xs = [0, 4, 4, 2, 2, 1, 1, 0]
+        ys = [0, 0, 3, 3, 1, 1, 3, 3]
+        px, py = random.uniform(-1, 5, size=(2, 10, 100))
+        is_in = points_in_polygon(px, py, xs, ys)
+        self.assertEqual(is_in.shape, (10, 100))
+        self.assertEqual(
+            is_in.ravel().tolist(),
+            [is_in_polygon(x, y, xs, ys) for x, y in zip(px.ravel(), py.ravel())],
+        )
+
+    def test_PreparedPolygon(self):
+        import numpy
+
+        random = numpy.random.default_rng(42)
+        ths = numpy.linspace(0, 2 * pi, 200, endpoint=False)
+        rs = 1 + 0.5 * numpy.sin(7 * ths)
+        for xs, ys in (
+            ([0, 2, 2, 0], [0, 0, 3, 3]),
+            ([0, 4, 4, 2, 2, 1, 1, 0], [0, 0, 3, 3, 1, 1, 3, 3]),
+            ([0, 2, 2, 1], [0, 0, 2, 2]),
+            (numpy.cos(ths), numpy.sin(ths)),
+            (numpy.cos(ths)[::-1], numpy.sin(ths)[::-1]),
+            (rs * numpy.cos(ths), rs * numpy.sin(ths)),
+            (rs * numpy.cos(ths)[::-1], rs * numpy.sin(ths)[::-1]),
+        ):
+            polygon = PreparedPolygon(xs, ys)
+            px, py = random.uniform(-2, 4, size=(2, 20, 300))
+            px[0, : len(xs)] = xs
+            py[0, : len(ys)] = ys
+            if isinstance(xs, list):
+                px[1, : len(xs)] = (numpy.array(xs) + numpy.roll(xs, -1)) / 2
+                py[1, : len(ys)] = (numpy.array(ys) + numpy.roll(ys, -1)) / 2
+            self.assertEqual(
+                polygon.contains_points(px, py).tolist(),
+                points_in_polygon(px, py, xs, ys).tolist(),
+            )
+        self.assertTrue(PreparedPolygon([0, 2, 2, 0], [0, 0, 2, 2]).is_convex)
+        self.assertFalse(
+            PreparedPolygon(rs * numpy.cos(ths), rs * numpy.sin(ths)).is_convex
+        )
+        xys = [(0, 0), (2, 0), (2, 1), (2, 2), (1, 2)]
+        polygon = PreparedPolygon([x for x, _ in xys], [y for _, y in xys])
+        self.assertTrue(polygon.contains(1, 1))
+        self.assertTrue(polygon.contains(2, 1))
+        self.assertFalse(polygon.contains(3, 3))
+        self.assertFalse(polygon.contains(3, 0))
+        self.assertFalse(polygon.contains(-1, 0))
+
+        # Convex polygons with collinear or duplicate vertices, including the first one.
+        px, py = numpy.mgrid[-3:3.25:0.25, -3:3.25:0.25]
+        for xs, ys in (
+            ([2, 0, -2, 2, 2], [1, 2, -2, -1, 0]),
+            ([0, 1, 2, 2, 2, 0, 0], [0, 0, 0, 1, 2, 2, 2]),
+            ([1, 2, 2, 0, 0, 0], [0, 0, 2, 2, 0, 0]),
+            ([1, 0, 0, 2, 2, 2], [0, 0, 2, 2, 0, 0]),
+            ([0, 1, 2], [0, 1, 2]),
+        ):
+            polygon = PreparedPolygon(xs, ys)
+            self.assertEqual(
+                polygon.contains_points(px, py).tolist(),
+                points_in_polygon(px, py, xs, ys).tolist(),
+            )
+        self.assertFalse(
+            PreparedPolygon([2, 0, -2, 2, 2], [1, 2, -2, -1, 0]).contains(2, -1.5)
+        )
+
+    def test_PolygonIndex(self):
+        import numpy
+
+        random = numpy.random.default_rng(42)
+        polygons = [
+            ([x, x + 1, x + 1, x], [y, y, y + 1, y + 1])
+            for x in range(20)
+            for y in range(15)
+        ]
+        polygons.append(([0.5, 3, 1], [0.5, 1, 3]))
+        polygons.append(([5, 9, 9, 7, 7, 6, 6, 5], [5, 5, 8, 8, 6, 6, 8, 8]))
+        index = PolygonIndex(polygons, node_size=4)
+        self.assertEqual(len(index), len(polygons))
+        px, py = random.uniform(-1, 21, size=(2, 500))
+        px[:3] = (0.7, 1, 6.5)
+        py[:3] = (0.6, 1.5, 7.5)
+        expected = [
+            [i for i, (xs, ys) in enumerate(polygons) if is_in_polygon(x, y, xs, ys)]
+            for x, y in zip(px.tolist(), py.tolist())
+        ]
+        self.assertEqual(expected[:3], [[0, 300], [1, 16, 300], [97]])
+        self.assertEqual(index.lookup_all(px, py), expected)
+        self.assertEqual(index.lookup_all(px, py, n_chunks=3), expected)
+        expected = [ids[0] if ids else -1 for ids in expected]
+        self.assertEqual(index.lookup(px, py).tolist(), expected)
+        self.assertEqual(index.lookup(px, py, n_chunks=3).tolist(), expected)
+        self.assertEqual(
+            PolygonIndex(polygons[:1]).lookup([0.5, 2], [0.5, 2]).tolist(), [0, -1]
+        )
+        index = PolygonIndex([([2, 0, -2, 2, 2], [1, 2, -2, -1, 0])])
+        self.assertEqual(index.lookup([2, 1], [-1.5, 0]).tolist(), [-1, 0])
+
     def test_is_in_convex_polygon(self):
+        import numpy
+
         with self.assertRaises(AssertionError):
             is_in_convex_polygon(1, 2, [(0, 0), (1, 0), (1, -1)])
         self.assertTrue(is_in_convex_polygon(0, 0, [(0, 0), (1, 0), (1, 1)]))
@@ -1160,6 +4570,9 @@ class _Tester(unittest.TestCase):
         self.assertTrue(is_in_convex_polygon(1, 1, xys))
         self.assertTrue(is_in_convex_polygon(1, 1, list(reversed(xys)), False))
         self.assertFalse(is_in_convex_polygon(3, 3, xys))
+        self.assertTrue(is_in_convex_polygon(1, 1, numpy.array(xys)))
+        self.assertTrue(is_in_convex_polygon(1, 1, numpy.array(xys[::-1]), False))
+        self.assertFalse(is_in_convex_polygon(3, 3, numpy.array(xys)))
 
     def test_is_convex(self):
         with self.assertRaises(AssertionError):
@@ -1173,6 +4586,43 @@ class _Tester(unittest.TestCase):
         self.assertFalse(is_convex([(0, 0), (1, 0), (0.5, 1), (0, 5)]))
         self.assertFalse(is_convex([(0, 0), (0.5, 1), (1, 0)]))
         self.assertTrue(is_convex([(0, 0), (0.5, 1), (1, 0)], False))
+        self.assertFalse(is_convex([(0, 5), (0.5, 1), (1, 0), (0, 0)], False))
+
+    def test_are_convex(self):
+        import numpy
+
+        xyss = [
+            [(0, 0), (1, 0), (0.5, 1)],
+            [(0, 0), (1, 0), (1, 1), (1, 2), (0, 1)],
+            [(0, 0), (1, 0), (0.5, 1), (0, 5)],
+            [(0, 0), (0.5, 1), (1, 0)],
+            numpy.array([(0, 0), (2, 0), (2, 1), (1, 1), (1, 2), (0, 2)]),
+        ]
+        self.assertEqual(are_convex(xyss).tolist(), [True, True, False, False, False])
+        self.assertEqual(
+            are_convex(xyss, False).tolist(), [False, False, False, True, False]
+        )
+        self.assertEqual(are_convex(xyss).tolist(), [is_convex(xys) for xys in xyss])
+        self.assertEqual(are_convex([]).tolist(), [])
+        with self.assertRaises(AssertionError):
+            are_convex([[(0, 0), (1, 0), (0.5, 1)], [(0, 0), (1, 0)]])
+        self.assertFalse(is_convex([(1, 0), (0.5, 1), (0, 5), (0, 0)]))
+
+    def test_signed_area(self):
+        with self.assertRaises(AssertionError):
+            signed_area([(0, 0), (1, 0)])
+        self.assertAlmostEqual(signed_area([(0, 0), (2, 0), (2, 3), (0, 3)]), 6)
+        self.assertAlmostEqual(signed_area([(0, 0), (0, 3), (2, 3), (2, 0)]), -6)
+        self.assertEqual(orientation([(0, 0), (2, 0), (2, 3), (0, 3)]), 1)
+        self.assertEqual(orientation([(0, 0), (0, 3), (2, 3), (2, 0)]), -1)
+        self.assertEqual(orientation([(0, 0), (1, 1), (2, 2)]), 0)
+        xyss = [
+            [(0, 0), (2, 0), (2, 3), (0, 3)],
+            [(0, 0), (1, 1), (2, 2)],
+            [(0, 0), (0, 1), (1, 0)],
+        ]
+        self.assertEqual(signed_areas(xyss).tolist(), [6, 0, -0.5])
+        self.assertEqual(orientations(xyss).tolist(), [1, 0, -1])
 
     def test_each_cons(self):
         with self.assertRaises(AssertionError):
@@ -1208,6 +4658,293 @@ class _Tester(unittest.TestCase):
             [[(1, 3), (1, 4), (1, 5)], [(2, 3), (2, 4), (2, 5)]],
         )
 
+    def test_parallel_for_with_pool(self):
+        import multiprocessing
+
+        expected = [[(1, 3), (1, 4), (1, 5)], [(2, 3), (2, 4), (2, 5)]]
+        with multiprocessing.Pool(2) as pool:
+            for chunk_size in (None, 1, 4):
+                self.assertEqual(
+                    parallel_for(
+                        _fn_for_test_parallel_for,
+                        [1, 2],
+                        [3, 4, 5],
+                        chunk_size=chunk_size,
+                        pool=pool,
+                    ),
+                    expected,
+                )
+            self.assertEqual(
+                parallel_for(
+                    _fn_for_test_parallel_for, [1, 2], commons=(6,), pool=pool
+                ),
+                [(1, 6), (2, 6)],
+            )
+
+    def test_parallel_for_with_shared_commons(self):
+        import multiprocessing
+
+        import numpy
+
+        a = numpy.arange(12.0).reshape(3, 4)
+        self.assertEqual(
+            parallel_for(_fn_for_test_parallel_for_commons, [0, 2], commons=(a, 10)),
+            [(16.0, False), (48.0, False)],
+        )
+        with multiprocessing.Pool(2) as pool:
+            for b in (a, 2 * a, a[:, ::2]):
+                self.assertEqual(
+                    sorted(
+                        iparallel_for(
+                            _fn_for_test_parallel_for_commons,
+                            range(len(b)),
+                            commons=(b, 1),
+                            pool=pool,
+                        )
+                    ),
+                    [((i,), (x.sum() + 1, False)) for i, x in enumerate(b)],
+                )
+
+    def test_parallel_for_with_dtype(self):
+        import multiprocessing
+
+        import numpy
+
+        a = numpy.arange(12.0).reshape(3, 4)
+        ret = parallel_for(
+            _fn_for_test_parallel_for_dtype,
+            range(3),
+            range(4),
+            commons=(a,),
+            dtype="f8",
+        )
+        self.assertEqual(ret.shape, (3, 4))
+        self.assertEqual(ret.dtype, numpy.float64)
+        self.assertTrue(numpy.array_equal(ret, a * a))
+        with multiprocessing.Pool(2) as pool:
+            for b in (a, a[::-1]):
+                ret = parallel_for(
+                    _fn_for_test_parallel_for_dtype,
+                    range(3),
+                    range(4),
+                    commons=(b,),
+                    pool=pool,
+                    dtype=numpy.int32,
+                )
+                self.assertEqual(ret.dtype, numpy.int32)
+                self.assertTrue(numpy.array_equal(ret, b * b))
+        self.assertEqual(
+            parallel_for(
+                _fn_for_test_parallel_for_dtype, [], range(4), commons=(a,), dtype=int
+            ).shape,
+            (0, 4),
+        )
+
+    def test_parallel_for_with_backend(self):
+        import multiprocessing
+
+        import numpy
+
+        expected = [[(1, 3), (1, 4), (1, 5)], [(2, 3), (2, 4), (2, 5)]]
+        self.assertEqual(
+            parallel_for(
+                _fn_for_test_parallel_for, [1, 2], [3, 4, 5], backend="thread"
+            ),
+            expected,
+        )
+        self.assertEqual(
+            parallel_for(
+                _afn_for_test_parallel_for, [1, 2], [3, 4, 5], backend="asyncio"
+            ),
+            expected,
+        )
+        a = numpy.arange(12.0).reshape(3, 4)
+        for backend in ("thread", "asyncio"):
+            f = (
+                _fn_for_test_parallel_for_dtype
+                if backend == "thread"
+                else _afn_for_test_parallel_for_dtype
+            )
+            ret = parallel_for(
+                f, range(3), range(4), commons=(a,), dtype=float, backend=backend
+            )
+            self.assertTrue(numpy.array_equal(ret, a * a))
+        from multiprocessing.pool import ThreadPool
+
+        with ThreadPool(2) as pool:
+            self.assertEqual(
+                parallel_for(
+                    _fn_for_test_parallel_for,
+                    [1, 2],
+                    [3, 4, 5],
+                    pool=pool,
+                    backend="thread",
+                ),
+                expected,
+            )
+        with self.assertRaises(ValueError):
+            parallel_for(_fn_for_test_parallel_for, [1], [2], backend="fiber")
+
+    def test_iparallel_for_asyncio(self):
+        import asyncio
+
+        n_running = 0
+        n_running_max = 0
+        releases = []
+
+        async def f(i, n):
+            # The last task is released once all `n` tasks are running,
+            # and task `i` once the result of task `i + 1` is received.
+            nonlocal n_running, n_running_max
+            if not releases:
+                releases.extend(asyncio.Event() for _ in range(n))
+            n_running += 1
+            n_running_max = max(n_running, n_running_max)
+            if n_running == n:
+                releases[n - 1].set()
+            await releases[i].wait()
+            n_running -= 1
+            return i
+
+        vs = []
+        for _, v in iparallel_for(f, range(10), commons=(10,), backend="asyncio"):
+            vs.append(v)
+            if v > 0:
+                releases[v - 1].set()
+        self.assertEqual(vs, list(reversed(range(10))))
+        self.assertEqual(n_running_max, 10)
+
+        async def g(i):
+            nonlocal n_running, n_running_max
+            n_running += 1
+            n_running_max = max(n_running, n_running_max)
+            for _ in range(3):
+                await asyncio.sleep(0)
+            n_running -= 1
+            return i
+
+        n_running_max = 0
+        self.assertEqual(
+            sorted(iparallel_for(g, range(10), backend="asyncio", n_workers=3)),
+            [((i,), i) for i in range(10)],
+        )
+        self.assertEqual(n_running_max, 3)
+
+    def test_parallel_for_with_checkpoint(self):
+        import tempfile
+
+        import threading
+
+        lock = threading.Lock()
+        calls = []
+
+        def f(i, j, fails):
+            with lock:
+                calls.append((i, j))
+                if (i, j) in fails:
+                    fails.remove((i, j))
+                    raise ValueError((i, j))
+            return i * j
+
+        expected = [[i * j for j in range(4)] for i in range(3)]
+        with tempfile.TemporaryDirectory() as td:
+            checkpoint = jp(td, "checkpoint")
+            with self.assertRaises(Error):
+                parallel_for(
+                    f,
+                    range(3),
+                    range(4),
+                    commons=({(1, 2), (2, 3)},),
+                    backend="thread",
+                    checkpoint=checkpoint,
+                )
+            self.assertEqual(len(calls), 12)
+            with AppendDbV1(checkpoint) as db:
+                self.assertEqual(len(db), 10)
+            calls.clear()
+            self.assertEqual(
+                parallel_for(
+                    f,
+                    range(3),
+                    range(4),
+                    commons=({(2, 3)},),
+                    backend="thread",
+                    checkpoint=checkpoint,
+                    retries=1,
+                ),
+                expected,
+            )
+            self.assertEqual(sorted(calls), [(1, 2), (2, 3), (2, 3)])
+            calls.clear()
+            self.assertEqual(
+                parallel_for(
+                    f, range(3), range(4), commons=(set(),), checkpoint=checkpoint
+                ),
+                expected,
+            )
+            self.assertEqual(calls, [])
+            with open(jp(checkpoint, "index.i64"), "r+b") as fp:
+                fp.truncate(11 * 8)
+            resume = functools.partial(
+                parallel_for,
+                f,
+                range(3),
+                range(4),
+                commons=(set(),),
+                backend="thread",
+                checkpoint=checkpoint,
+            )
+            calls.clear()
+            with self.assertLogs(logger, logging.WARNING):
+                self.assertEqual(resume(), expected)
+            self.assertEqual(len(calls), 1)
+            calls.clear()
+            self.assertEqual(resume(), expected)
+            self.assertEqual(calls, [])
+            self.assertEqual(
+                parallel_for(
+                    _fn_for_test_parallel_for,
+                    [1, 2],
+                    [3, 4, 5],
+                    checkpoint=jp(td, "process"),
+                ),
+                [[(1, 3), (1, 4), (1, 5)], [(2, 3), (2, 4), (2, 5)]],
+            )
+            self.assertEqual(
+                parallel_for(
+                    _afn_for_test_parallel_for,
+                    [1, 2],
+                    [3, 4, 5],
+                    backend="asyncio",
+                    checkpoint=jp(td, "process"),
+                ),
+                [[(1, 3), (1, 4), (1, 5)], [(2, 3), (2, 4), (2, 5)]],
+            )
+
+    def test_iparallel_for(self):
+        import multiprocessing
+
+        self.assertEqual(
+            sorted(iparallel_for(_fn_for_test_parallel_for, [1, 2], [3, 4, 5])),
+            [
+                ((0, 0), (1, 3)),
+                ((0, 1), (1, 4)),
+                ((0, 2), (1, 5)),
+                ((1, 0), (2, 3)),
+                ((1, 1), (2, 4)),
+                ((1, 2), (2, 5)),
+            ],
+        )
+        with multiprocessing.Pool(2) as pool:
+            g = iparallel_for(
+                _fn_for_test_parallel_for, range(100), commons=(7,), pool=pool
+            )
+            self.assertEqual(sorted(v for _, v in g), [(i, 7) for i in range(100)])
+            self.assertEqual(
+                list(iparallel_for(_fn_for_test_parallel_for, [1], [2], pool=pool)),
+                [((0, 0), (1, 2))],
+            )
+
     def test_reshape(self):
         with self.assertRaises(AssertionError):
             reshape((1,), ())
@@ -1238,6 +4975,265 @@ class _Tester(unittest.TestCase):
         ):
             self.assertEqual(partition(xs, n), expected)
 
+    def test_memoize(self):
+        import time
+
+        calls = []
+
+        def f(x, y=1):
+            calls.append(x)
+            return [x] * y
+
+        g = memoize(f)
+        self.assertEqual(g(1), [1])
+        self.assertIs(g(1), g(1))
+        self.assertEqual(calls, [1])
+        self.assertEqual(g.cache, {(1,): [1]})
+        self.assertEqual(g.cache_info(), MemoizeInfo(None, None, None, 1, None))
+        g.cache_clear()
+        self.assertEqual(g.cache_info(), MemoizeInfo(None, None, None, 0, None))
+
+        calls.clear()
+        g = memoize(maxsize=2)(f)
+        for x in (1, 2, 1, 3, 2, 1):
+            g(x)
+        self.assertEqual(calls, [1, 2, 3, 2, 1])
+        self.assertEqual(list(g.cache), [(2,), (1,)])
+        self.assertEqual(g.cache_info(), MemoizeInfo(1, 5, 2, 2, None))
+
+        g = memoize(maxbytes=2, sizeof=len)(f)
+        g(1, 1)
+        g(2, 1)
+        self.assertEqual(list(g.cache), [(1, 1), (2, 1)])
+        g(3, 2)
+        self.assertEqual(list(g.cache), [(3, 2)])
+        self.assertEqual(g.cache_info().nbytes, 2)
+        g(4, 3)
+        self.assertEqual(g.cache_info(), MemoizeInfo(0, 4, None, 0, 0))
+
+        calls.clear()
+        g = memoize(ttl=0.05)(f)
+        g(1)
+        g(1)
+        g(2)
+        self.assertEqual(calls, [1, 2])
+        time.sleep(0.06)
+        g(1)
+        self.assertEqual(calls, [1, 2, 1])
+        self.assertEqual(list(g.cache), [(1,)])
+
+    def test_memoize_key(self):
+        import numpy
+
+        calls = []
+
+        def h(xs, *, scale=1, offset=0):
+            calls.append(1)
+            return numpy.sum(xs) * scale + offset
+
+        f = memoize(key=memoize_key)(h)
+        a = numpy.arange(6.0).reshape(2, 3)
+        self.assertEqual(f(a), 15)
+        self.assertEqual(f(a.copy()), 15)
+        self.assertEqual(f(a.T.copy().T), 15)
+        self.assertEqual(f(a, offset=1, scale=2), 31)
+        self.assertEqual(f(a, scale=2, offset=1), 31)
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(f(a.astype(numpy.float32)), 15)
+        self.assertEqual(f(a.reshape(3, 2)), 15)
+        self.assertEqual(len(calls), 4)
+        a[0, 0] = 1
+        self.assertEqual(f(a), 16)
+        self.assertEqual(f([1, 2, 3]), 6)
+        self.assertEqual(f([1, 2, 3]), 6)
+        self.assertEqual(f((1, 2, 3)), 6)
+        self.assertEqual(len(calls), 7)
+        self.assertEqual(f.cache_info().currsize, 7)
+
+        self.assertEqual(
+            memoize_key({"a": [1], "b": {2}}), memoize_key({"b": {2}, "a": [1]})
+        )
+        self.assertNotEqual(memoize_key([1]), memoize_key((1,)))
+        o = numpy.array([[1], "a"], dtype=object)
+        self.assertEqual(memoize_key(o), memoize_key(o.copy()))
+
+        calls.clear()
+        g = memoize(key=memoize_identity_key)(h)
+        b = numpy.ones(3)
+        self.assertEqual(g(b), 3)
+        b[0] = 2
+        self.assertEqual(g(b), 3)
+        self.assertEqual(g(b.copy()), 4)
+        self.assertEqual(g(xs=b), 4)
+        self.assertEqual(len(calls), 3)
+
+    def test_profiled_memoize(self):
+        g = profiled_memoize(maxsize=1)(lambda x: x)
+        for x in (1, 1, 2, 1):
+            g(x)
+        self.assertEqual(g.profile, {"new": 3, "hit": 1})
+        self.assertEqual(g.cache, {(1,): 1})
+        g = profiled_memoize(lambda x: x)
+        for x in (1, 1, 2, 1):
+            g(x)
+        self.assertEqual(g.profile, {"new": 2, "hit": 2})
+        self.assertEqual(g.cache, {(1,): 1, (2,): 2})
+        self.assertEqual(g.cache_info(), MemoizeInfo(2, 2, None, 2, None))
+
+    def test_concurrent_memoize(self):
+        import threading
+        import time
+
+        calls = []
+
+        @concurrent_memoize(maxsize=10)
+        def f(x):
+            calls.append(x)
+            time.sleep(0.05)
+            if x < 0:
+                raise ValueError(x)
+            return [x]
+
+        barrier = threading.Barrier(8)
+        results = []
+        errors = []
+
+        def run(x):
+            barrier.wait()
+            try:
+                results.append(f(x))
+            except ValueError as e:
+                errors.append(e)
+
+        for xs in ([1] * 8, [1, 2] * 4, [-1] * 8):
+            threads = [threading.Thread(target=run, args=(x,)) for x in xs]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        self.assertEqual(calls, [1, 2, -1])
+        self.assertEqual(len(results), 16)
+        self.assertEqual(len(errors), 8)
+        self.assertEqual(f.cache_info(), MemoizeInfo(21, 2, 10, 2, None))
+        self.assertTrue(all(r is f(1) for r in results if r == [1]))
+        f.cache_clear()
+        self.assertEqual(f.cache, {})
+
+    def test_async_memoize(self):
+        import asyncio
+
+        calls = []
+
+        @async_memoize
+        async def f(x):
+            calls.append(x)
+            await asyncio.sleep(0.01)
+            if x < 0:
+                raise ValueError(x)
+            return [x]
+
+        async def main():
+            rs = await asyncio.gather(f(1), f(1), f(2), f(1))
+            self.assertEqual(rs, [[1], [1], [2], [1]])
+            self.assertIs(rs[0], rs[1])
+            self.assertIs(await f(1), rs[0])
+            rs = await asyncio.gather(f(-1), f(-1), return_exceptions=True)
+            self.assertTrue(all(isinstance(r, ValueError) for r in rs))
+
+        asyncio.run(main())
+        self.assertEqual(calls, [1, 2, -1])
+        self.assertEqual(f.cache, {(1,): [1], (2,): [2]})
+
+    def test_disk_memoize(self):
+        import subprocess
+        import tempfile
+
+        calls = []
+
+        def f(x, n=1):
+            calls.append(x)
+            return [x] * n
+
+        with tempfile.TemporaryDirectory() as td:
+            g1 = disk_memoize(td)(f)
+            g2 = disk_memoize(td)(f)
+            self.assertEqual(g1(1), [1])
+            self.assertEqual(g1(1), [1])
+            self.assertEqual(g2(1), [1])
+            self.assertEqual(g2(None), [None])
+            self.assertEqual(g1(None), [None])
+            self.assertEqual(calls, [1, None])
+            self.assertEqual(disk_memoize(td, version=2)(f)(1), [1])
+            self.assertEqual(calls, [1, None, 1])
+            with open(jp(td, "000000000000.bin"), "ab") as fp:
+                fp.write(b"\x01\x02")
+            g3 = disk_memoize(td)(f)
+            self.assertEqual(g3(None), [None])
+            self.assertEqual(g3(2), [2])
+            self.assertEqual(g3(2), [2])
+            self.assertEqual(g2(2), [2])
+            self.assertEqual(disk_memoize(td)(f)(2), [2])
+            self.assertEqual(calls, [1, None, 1, 2])
+            self.assertEqual(
+                sorted(os.listdir(td)), ["000000000000.bin", "000000000001.bin"]
+            )
+            g1.cache_clear()
+            self.assertEqual(os.listdir(td), [])
+            self.assertEqual(g1(1), [1])
+            self.assertEqual(calls, [1, None, 1, 2, 1])
+            g1.store.close()
+            g2.store.close()
+            g3.store.close()
+
+        with tempfile.TemporaryDirectory() as td:
+            keys = set()
+            for seed in ("0", "1", "2"):
+                p = subprocess.run(
+                    [
+                        sys.executable,
+                        "-c",
+                        "import kshramt; print(kshramt._canonical_bytes("
+                        "({'b': {'x', 'y', 'z'}, 'a': [frozenset({'p', 'q'})]}, 1.5)"
+                        ").hex())",
+                    ],
+                    env=dict(
+                        os.environ,
+                        PYTHONHASHSEED=seed,
+                        PYTHONPATH=dirname(os.path.abspath(__file__)),
+                    ),
+                    capture_output=True,
+                    text=True,
+                    check=True,
+                )
+                keys.add(p.stdout)
+            self.assertEqual(len(keys), 1)
+            self.assertEqual(
+                _canonical_bytes({"a": {1, 2}, "b": 3}),
+                _canonical_bytes({"b": 3, "a": {2, 1}}),
+            )
+            self.assertNotEqual(_canonical_bytes([1]), _canonical_bytes((1,)))
+            calls.clear()
+            g = disk_memoize(td)(f)
+            self.assertEqual(g({"a": 1, "b": 2}, n=2), [{"a": 1, "b": 2}] * 2)
+            self.assertEqual(g({"b": 2, "a": 1}, n=2), [{"a": 1, "b": 2}] * 2)
+            self.assertEqual(g({"b": 2, "a": 1}), [{"a": 1, "b": 2}])
+            self.assertEqual(len(calls), 2)
+            g.store.close()
+
+        with tempfile.TemporaryDirectory() as td:
+            g = disk_memoize(td, maxbytes=4000)(f)
+            for x in range(20):
+                g(x, 100)
+            self.assertLessEqual(
+                sum(os.stat(jp(td, name)).st_size for name in os.listdir(td)), 4000
+            )
+            self.assertGreater(len(os.listdir(td)), 1)
+            calls.clear()
+            g(19, 100)
+            g(0, 100)
+            self.assertEqual(calls, [0])
+            g.store.close()
+
     def test__get_interval(self):
         with self.assertRaises(AssertionError):
             _get_interval(-1)
@@ -1331,7 +5327,66 @@ class _Tester(unittest.TestCase):
         with self.assertRaises(AssertionError):
             parse_fixed_width("12345")
 
+    def test_make_load_fixed_width(self):
+        import bz2
+        import gzip
+        import io
+        import lzma
+        import tempfile
+
+        fields = (("density", 3, int), 2, ("opacity", 7, float), ("name", 4, str))
+        lines = [f"{i:3d}xx{i / 8:7.3f}{chr(97 + i % 3)}{i:03d}" for i in range(1000)]
+        b = "".join(line + "\n" for line in lines).encode("utf-8")
+        parse = make_parse_fixed_width(fields)
+        expected = [parse(line) for line in lines]
+        with tempfile.TemporaryDirectory() as td:
+            for ext, open_ in (
+                ("", open),
+                (".gz", gzip.open),
+                (".bz2", bz2.open),
+                (".xz", lzma.open),
+            ):
+                path = jp(td, "catalog.txt" + ext)
+                with open_(path, "wb") as fp:
+                    fp.write(b)
+                for background in (False, True):
+                    load = make_load_fixed_width(
+                        fields, block_size=1000, background=background
+                    )
+                    batches = list(load(path))
+                    self.assertGreater(len(batches), 1)
+                    self.assertEqual(
+                        [
+                            (d, o, n)
+                            for batch in batches
+                            for d, o, n in zip(
+                                batch["density"].tolist(),
+                                batch["opacity"].tolist(),
+                                batch["name"].tolist(),
+                            )
+                        ],
+                        [(r["density"], r["opacity"], r["name"]) for r in expected],
+                    )
+
+        load = make_load_fixed_width((("a", 2, int), ("b", 1, bytes), ("c", 1, ord)))
+        (batch,) = load(io.BytesIO(b" 1x1\n-2y2\n"))
+        self.assertEqual(batch["a"].tolist(), [1, -2])
+        self.assertEqual(batch["b"].tolist(), [b"x", b"y"])
+        self.assertEqual(batch["c"].tolist(), [49, 50])
+        self.assertEqual(
+            [batch["a"].tolist() for batch in load(io.BytesIO(b" 1x1\n-2y2"))],
+            [[1], [-2]],
+        )
+        with self.assertRaises(Error):
+            list(load(io.BytesIO(b" 1x1\n-2y2\n3")))
+        with self.assertRaises(Error):
+            list(load(io.BytesIO(b" 1x1 -2y2\n")))
+        with self.assertRaises(ValueError):
+            list(load(io.BytesIO(b""), compression="zip"))
+
     def test_AppendDbV1(self):
+        import tempfile
+
         with tempfile.TemporaryDirectory() as td:
             with AppendDbV1(jp(td, "l1")) as ad:
                 assert len(ad) == 0, len(ad)
@@ -1362,10 +5417,301 @@ class _Tester(unittest.TestCase):
                 assert ad[0] == "どうだろう？\n", repr(ad[0])
                 ad.append("OK??\n")
                 assert ad[2] == "OK??\n", repr(ad[2])
+            with open(jp(td, "l1", "data.txt"), "ab") as fp:
+                fp.write(b"GAR")
+            with open(jp(td, "l1", "index.i64"), "ab") as fp:
+                fp.write(b"\x01\x02")
+            with AppendDbV1(jp(td, "l1")) as ad:
+                with self.assertLogs(logger, logging.WARNING):
+                    ad.append("xyz")
+                self.assertEqual(ad[3], "xyz")
+                with open(jp(td, "l1", "data.txt"), "ab") as fp:
+                    fp.write(b"GAR")
+                with self.assertLogs(logger, logging.WARNING):
+                    ad.extend(["a", "b"])
+                self.assertEqual([ad[i] for i in range(3, 6)], ["xyz", "a", "b"])
+                ad.fp_data.truncate(3)
+                with self.assertRaises(Error):
+                    ad.append("c")
+
+    def test_BytesAppendDbV1(self):
+        import tempfile
+
+        with tempfile.TemporaryDirectory() as td:
+            with BytesAppendDbV1(td) as db:
+                db.append(b"\x00\xff")
+                db.extend([b"", b"abc"])
+                self.assertEqual(
+                    [db[i] for i in range(len(db))], [b"\x00\xff", b"", b"abc"]
+                )
+            with AppendDbV1(td) as db:
+                self.assertEqual(db[2], "abc")
+
+    def test_FixedAppendDbV1(self):
+        import numpy
+        import tempfile
+
+        dtype = [("t", "<f8"), ("n", "<i4")]
+        with tempfile.TemporaryDirectory() as td:
+            with FixedAppendDbV1(td, dtype) as db:
+                self.assertEqual(len(db), 0)
+                self.assertEqual(len(db.array()), 0)
+                db.append((1.5, 2))
+                db.extend([(2.5, 3), (3.5, 4)])
+                db.extend(numpy.array([(4.5, 5)], dtype=dtype))
+                self.assertEqual(len(db), 4)
+                self.assertEqual(db[-1]["n"], 5)
+                self.assertEqual(tuple(db[1]), (2.5, 3))
+                xs = db.array()
+                self.assertEqual(xs["t"].tolist(), [1.5, 2.5, 3.5, 4.5])
+                self.assertEqual(xs["n"].sum(), 14)
+                self.assertFalse(xs.flags.writeable)
+                del xs
+            with open(jp(td, "data.bin"), "ab") as fp:
+                fp.write(b"\x01\x02")
+            with self.assertLogs(logger, logging.WARNING):
+                db = FixedAppendDbV1(td, dtype, recover=True)
+            with db:
+                self.assertEqual(db.recover(), 0)
+                db.append((5.5, 6))
+                self.assertEqual(db.array()["n"].tolist(), [2, 3, 4, 5, 6])
+            with open(jp(td, "data.bin"), "ab") as fp:
+                fp.write(b"\x01")
+            with FixedAppendDbV1(td, dtype) as db:
+                with self.assertLogs(logger, logging.WARNING):
+                    db.append((6.5, 7))
+                self.assertEqual(db.array()["n"].tolist(), [2, 3, 4, 5, 6, 7])
+            with FixedAppendDbV1(td, struct.Struct("<dI")) as db:
+                self.assertEqual(tuple(db[0]), (1.5, 2))
+            with self.assertRaises(ValueError):
+                FixedAppendDbV1(td, struct.Struct("dI"))
+        self.assertEqual(
+            numpy.dtype(_dtype_of_struct(struct.Struct(">2h?3sx"))).descr,
+            [("f0", ">i2"), ("f1", ">i2"), ("f2", "|b1"), ("f3", "|S3"), ("f4", "|V1")],
+        )
+        self.assertEqual(_dtype_of_struct(struct.Struct("<2h 3s x")), "<i2,<i2,S3,V1")
+        with self.assertRaises(ValueError):
+            _dtype_of_struct(struct.Struct("<dp"))
+
+    def test_SegmentedAppendDb(self):
+        import tempfile
+
+        with tempfile.TemporaryDirectory() as td:
+            with SegmentedAppendDb(td, segment_bytes=10) as db:
+                self.assertEqual(len(db), 0)
+                with self.assertRaises(IndexError):
+                    db[0]
+                for i in range(9):
+                    db.append(f"{i:04d}\n")
+                db.extend(["a", "b"])
+                self.assertEqual(len(db), 11)
+                self.assertEqual(db[4], "0004\n")
+                self.assertEqual(db[-1], "b")
+            self.assertEqual(
+                sorted(os.listdir(td)), [f"{i:020d}" for i in (0, 2, 4, 6, 8)]
+            )
+            archived = []
+            with SegmentedAppendDb(td, segment_bytes=10) as db:
+                self.assertEqual(db.starts, [0, 2, 4, 6, 8])
+                self.assertEqual(db[9], "a")
+                self.assertEqual(
+                    db.retain(max_segments=4, archive=archived.append), [0]
+                )
+                self.assertEqual(archived, [jp(td, f"{0:020d}")])
+                self.assertEqual(db.start, 2)
+                with self.assertRaises(IndexError):
+                    db[1]
+                self.assertEqual(db[2], "0002\n")
+                self.assertEqual(db.retain(max_age=3600), [])
+                for start in (2, 4):
+                    os.utime(jp(td, f"{start:020d}", "data.txt"), (0, 0))
+                self.assertEqual(db.retain(max_age=3600), [2, 4])
+                self.assertEqual(db.retain(max_segments=1), [6])
+                self.assertEqual(db.retain(max_segments=1, max_age=0), [])
+                self.assertEqual(len(db), 11)
+                self.assertEqual(db[8], "0008\n")
+                db.append("c")
+                self.assertEqual(db.starts, [8])
+                self.assertEqual(
+                    [db[i] for i in range(db.start, len(db))], ["0008\n", "a", "b", "c"]
+                )
+            with SegmentedAppendDb(jp(td, "many"), 1, max_open_segments=2) as db:
+                db.extend(["x"])
+                for i in range(20):
+                    db.append(f"{i}")
+                self.assertEqual(len(db.starts), 21)
+                dbs = [db._db_of(start) for start in db.starts[:3]]
+                self.assertEqual(
+                    [db[i] for i in range(1, 21)], list(map(str, range(20)))
+                )
+                self.assertEqual(list(db._dbs), [18, 19])
+                self.assertTrue(all(d.fp_data.closed for d in dbs))
+                self.assertEqual(db[0], "x")
+                self.assertEqual(list(db._dbs), [19, 0])
+            with open(jp(td, f"{8:020d}", "data.txt"), "ab") as fp:
+                fp.write(b"GAR")
+            with SegmentedAppendDb(td, segment_bytes=10) as db:
+                with self.assertLogs(logger, logging.WARNING):
+                    self.assertEqual(len(db), 12)
+                db.append("d")
+                self.assertEqual(db[12], "d")
+
+    def test_AsyncAppendDb(self):
+        import asyncio
+        import tempfile
+
+        async def main(td):
+            async with AsyncAppendDb(td, max_batch=7) as db:
+                ts = [f"{i}\n" for i in range(50)]
+                ids = await asyncio.gather(*(db.append(t) for t in ts))
+                self.assertEqual(ids, list(range(50)))
+                self.assertEqual(await db.length(), 50)
+                self.assertEqual(
+                    await asyncio.gather(*(db.get(i) for i in range(50))), ts
+                )
+                self.assertEqual(await db.get(-1), "49\n")
+                self.assertEqual(await db.append("x"), 50)
+            with self.assertRaises(Error):
+                await db.append("y")
+            async with AsyncAppendDb(td, fsync=False) as db:
+                self.assertEqual(await db.append("y"), 51)
+                rets = await asyncio.gather(
+                    db.append("z"),
+                    db.append(None),
+                    db.append("w"),
+                    return_exceptions=True,
+                )
+                self.assertEqual(rets[0::2], [52, 53])
+                self.assertIsInstance(rets[1], AttributeError)
+
+        with tempfile.TemporaryDirectory() as td:
+            asyncio.run(main(td))
+            with AppendDbV1(td) as db:
+                self.assertEqual(len(db), 54)
+                self.assertEqual(db[50], "x")
+                db.extend(["a", "", "bc"])
+                db.extend([])
+                self.assertEqual(
+                    [db[i] for i in range(51, len(db))], ["y", "z", "w", "a", "", "bc"]
+                )
+                db.sync()
+
+    def test_AppendDbV1_follow(self):
+        import asyncio
+        import tempfile
+        import threading
+        import time
+
+        def write(path, ts):
+            with AppendDbV1(path) as db:
+                for t in ts:
+                    time.sleep(0.01)
+                    db.append(t)
+
+        async def afollow(path, **kwargs):
+            with AppendDbV1(path) as db:
+                return [t async for t in db.afollow(1, timeout=0.5, **kwargs)]
+
+        for inotify in (True, False):
+            with tempfile.TemporaryDirectory() as td:
+                with AppendDbV1(td) as db:
+                    db.extend(["a", "b"])
+                    writer = threading.Thread(target=write, args=(td, ["c", "", "d"]))
+                    writer.start()
+                    self.assertEqual(
+                        list(db.follow(1, timeout=0.5, inotify=inotify)),
+                        ["b", "c", "", "d"],
+                    )
+                    writer.join()
+                    self.assertEqual(list(db.follow(5, timeout=0.01)), [])
+                    writer = threading.Thread(target=write, args=(td, ["e"]))
+                    writer.start()
+                    self.assertEqual(
+                        asyncio.run(afollow(td, inotify=inotify)),
+                        ["b", "c", "", "d", "e"],
+                    )
+                    writer.join()
+                    self.assertEqual(db._records(0, 6), ["a", "b", "c", "", "d", "e"])
+
+    def test_AppendDbV1_recover(self):
+        import tempfile
+
+        with tempfile.TemporaryDirectory() as td:
+            with AppendDbV1(td) as db:
+                for t in ("a", "bc", "", "def"):
+                    db.append(t)
+                self.assertEqual(db.recover(), (0, 0))
+            with open(jp(td, "index.i64"), "ab") as fp:
+                fp.write(b"\x01\x02\x03")
+            with open(jp(td, "data.txt"), "ab") as fp:
+                fp.write(b"garbage")
+            with self.assertLogs(logger, logging.WARNING):
+                db = AppendDbV1(td, recover=True)
+            with db:
+                self.assertEqual(len(db), 4)
+                db.append("gh")
+                self.assertEqual(
+                    [db[i] for i in range(len(db))], ["a", "bc", "", "def", "gh"]
+                )
+            with open(jp(td, "data.txt"), "ab") as fp:
+                fp.truncate(4)
+            with AppendDbV1(td) as db:
+                self.assertEqual(db.recover(), (2 * 8, 1))
+                self.assertEqual([db[i] for i in range(len(db))], ["a", "bc", ""])
+            with open(jp(td, "data.txt"), "ab") as fp:
+                fp.truncate(0)
+            with AppendDbV1(td) as db:
+                self.assertEqual(db.recover(), (3 * 8, 0))
+                self.assertEqual(len(db), 0)
+
+        for n_zeros in (1, 2, 5):
+            for ts in (["abc", "d", "ef"], ["", "abc", "", "d", "ef", "ghi", "j"]):
+                with tempfile.TemporaryDirectory() as td:
+                    with AppendDbV1(td) as db:
+                        db.extend(ts)
+                    with open(jp(td, "index.i64"), "ab") as fp:
+                        fp.write(b"\x00" * 8 * n_zeros)
+                    with self.assertLogs(logger, logging.WARNING):
+                        db = AppendDbV1(td, recover=True)
+                    with db:
+                        self.assertEqual([db[i] for i in range(len(db))], ts)
+                        self.assertEqual(db.recover(), (0, 0))
+        with tempfile.TemporaryDirectory() as td:
+            with AppendDbV1(td) as db:
+                db.extend(["", ""])
+            with open(jp(td, "data.txt"), "ab") as fp:
+                fp.write(b"x")
+            with AppendDbV1(td) as db:
+                self.assertEqual(db.recover(), (0, 1))
+                self.assertEqual([db[0], db[1]], ["", ""])
+
+        with tempfile.TemporaryDirectory() as td:
+            with AppendDbV1(td, footer=True) as db:
+                db.append("abc")
+                db.append("d")
+            self.assertTrue(os.path.exists(jp(td, "footer.bin")))
+            with AppendDbV1(td, footer=True) as db:
+                self.assertFalse(os.path.exists(jp(td, "footer.bin")))
+                db.append("e")
+            with open(jp(td, "data.txt"), "ab") as fp:
+                fp.write(b"garbage")
+            with self.assertLogs(logger, logging.WARNING):
+                db = AppendDbV1(td, footer=True)
+            with db:
+                self.assertEqual([db[i] for i in range(len(db))], ["abc", "d", "e"])
+            with open(jp(td, "footer.bin"), "r+b") as fp:
+                fp.write(b"\x00")
+            with open(jp(td, "data.txt"), "ab") as fp:
+                fp.write(b"garbage")
+            with self.assertLogs(logger, logging.WARNING):
+                AppendDbV1(td, footer=True).close()
+            self.assertEqual(os.stat(jp(td, "data.txt")).st_size, 5)
 
     if _PY37:
 
         def test_dataclass_of(self):
+            import dataclasses
+
             @dataclasses.dataclass
             class c4:
                 x: int
@@ -1401,6 +5747,9 @@ class _Tester(unittest.TestCase):
             self.assertEqual(x, dataclass_of(c1, dataclasses.asdict(x)))
 
         def test_dataclass_of_with_implicit_conversions(self):
+            import dataclasses
+            import decimal
+
             @dataclasses.dataclass
             class c2:
                 x: decimal.Decimal
@@ -1425,6 +5774,8 @@ class _Tester(unittest.TestCase):
             )
 
         def test_dataclass_of_handles_flaot_and_complex_correctly(self):
+            import dataclasses
+
             @dataclasses.dataclass
             class c1:
                 x: int
@@ -1451,6 +5802,8 @@ class _Tester(unittest.TestCase):
     else:
 
         def test_dataclass_of(self):
+            import dataclasses
+
             @dataclasses.dataclass
             class c4:
                 x: int
@@ -1486,6 +5839,9 @@ class _Tester(unittest.TestCase):
             self.assertEqual(x, dataclass_of(c1, dataclasses.asdict(x)))
 
         def test_dataclass_of_with_implicit_conversions(self):
+            import dataclasses
+            import decimal
+
             @dataclasses.dataclass
             class c2:
                 x: decimal.Decimal
@@ -1510,6 +5866,8 @@ class _Tester(unittest.TestCase):
             )
 
         def test_dataclass_of_handles_flaot_and_complex_correctly(self):
+            import dataclasses
+
             @dataclasses.dataclass
             class c1:
                 x: int
@@ -1534,5 +5892,40 @@ class _Tester(unittest.TestCase):
                 dataclass_of(c1, dict(x=1j, y=2, z=3))
 
 
+def _make_Tester():
+    import unittest
+
+    return type("_Tester", (_Tests, unittest.TestCase), {"__module__": __name__})
+
+
+_LAZY_ATTRIBUTES = {
+    "BenchAction": _make_BenchAction,
+    "TestAction": _make_TestAction,
+    "_Tester": _make_Tester,
+}
+
+
+def __getattr__(name):
+    """
+    Create `BenchAction`, `TestAction` and `_Tester` on first access to defer importing `argparse` and `unittest`.
+    """
+    try:
+        make = _LAZY_ATTRIBUTES[name]
+    except KeyError:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}") from None
+    v = globals()[name] = make()
+    return v
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_LAZY_ATTRIBUTES))
+
+
 if __name__ == "__main__":
-    unittest.main()
+    import argparse
+    import unittest
+
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument("--bench", action=_make_BenchAction())
+    _, argv = parser.parse_known_args()
+    unittest.main(argv=sys.argv[:1] + argv, defaultTest="_Tester")